@@ -2,88 +2,135 @@
 
 import json
 import os
-import re
 import shutil
 import sys
 import tempfile
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import metview as mv
 
+import util.archive
 import util.colormap
-from util import icon_eu_tilejson_bounds, bunny
-
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        out_dir = "/out"
-    else:
-        out_dir = sys.argv[1]
-    util.ensure_empty_dir(out_dir)
+import util.dwd
+import util.heat
+import util.journal
+import util.publish
+import util.reuse
+from util import icon_eu_tilejson_bounds
+
+# Areas of interest as left,bottom,right,top separated by ";". Only these subsets of the domain are colorized and tiled.
+areas = []
+for requested_area in util.parse_areas(os.getenv("ICON_EU_H_SNOW_AREAS")):
+    area = util.intersect_bounds(requested_area, icon_eu_tilejson_bounds)
+    if area is None:
+        raise RuntimeError(f"area {requested_area} is outside of the ICON-EU domain")
+    areas.append(area)
+if len(areas) == 0:
+    areas = [icon_eu_tilejson_bounds]
+tilejson_bounds = util.union_bounds(areas)
+
+# For the "encoded" output mode (cm, in steps of 0.1cm)
+value_encoding = util.encoded.Encoding(offset=0.0, scale=0.1)
+
+# The main runs go out to 120 hours
+max_step = 120
+step_interval = 12
+
+attribution = "<a href=\"https://www.dwd.de/EN/ourservices/nwp_forecast_data/nwp_forecast_data.html\" target=\"_blank\">Deutscher Wetterdienst</a>"
+
+
+def main(out_dir: str):
+    run_ts = util.dwd.latest_run("h_snow", datetime.now(timezone.utc).replace(tzinfo=None), max_step)
+    run = run_ts.strftime("%Y%m%d%H")
+    version_message = f"Updated at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M')} UTC to the {run_ts.strftime('%Y-%m-%d %H:%M')} UTC model run"
+    print("Version message:", version_message)
+
+    journal = util.journal.open_journal("icon_eu_h_snow", run)
+    if not journal.resumed:
+        util.ensure_empty_dir(out_dir)
+
+    # above the always complete low zooms, only the tiles people request
+    tile_filter = util.heat.tile_filter("icon_eu_h_snow")
+
+    # hours whose field is unchanged since an earlier run keep that run's layer
+    layers = util.reuse.Layers.load("icon_eu_h_snow", run)
 
     scratch_dir = tempfile.mkdtemp()
 
-    data_dir = tempfile.mkdtemp()
-    util.downloader_dwd(
-        "--directory", data_dir,
-        "--grid", "regular-lat-lon",
-        "--model", "icon-eu",
-        "--single-level-fields", "h_snow",
-        "--timestamp", datetime.now().date().strftime("%Y-%m-%d"),
-        "--min-time-step", "0",
-        "--max-time-step", "120",
-        "--time-step-interval", "12",
-    )
-    data_files = os.listdir(data_dir)
-    print("Downloaded", data_files)
-
-    zero_file = next(f for f in data_files if f.endswith("_000_H_SNOW.grib2"))
-    run = re.match("icon-eu_europe_regular-lat-lon_single-level_([0-9]{10})_000_H_SNOW.grib2", zero_file).group(1)
-    run_timestamp = datetime.strptime(run, "%Y%m%d%H")
-    version_message = f"Updated at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M')} UTC to the {run_timestamp.strftime('%Y-%m-%d %H:%M')} UTC model run"
-    print("Parsed version message:", version_message)
+    data_dir = journal.work_dir("download", scratch_dir)
+    data_files = util.dwd.fetch("h_snow", run_ts, list(range(0, max_step + 1, step_interval)), data_dir, journal)
 
     run_dir = os.path.join(out_dir, run)
     os.makedirs(run_dir, exist_ok=True)
 
     hours = []
-    for fname in data_files:
-        hour = re.match("icon-eu_europe_regular-lat-lon_single-level_[0-9]+_([0-9]{3})_H_SNOW.grib2", fname).group(1)
+    for data_file in data_files:
+        hour = f"{data_file.step:03d}"
         print(f"Processing {run}/{hour}")
 
         hour_dir = os.path.join(run_dir, hour)
-        os.makedirs(hour_dir, exist_ok=True)
 
-        grib_path = os.path.join(scratch_dir, fname)
         # convert meters to centimeters
-        fs = mv.Fieldset(path=os.path.join(data_dir, fname)) * 100
-        mv.write(grib_path, fs)
-
-        colorized_file = f"{hour}_colorized.tif"
-        util.colorize(grib_path, "colormaps/snow_depth_cm.txt", colorized_file)
-
-        util.generate_tiles(colorized_file, hour_dir)
-
-        tilejson = {
-            "tiles": ["https://plantopo-weather.b-cdn.net/icon_eu_h_snow/" + run + "/" + hour + "/{z}/{x}/{y}.png"],
-            "minzoom": 1,
-            "maxzoom": 5,
-            "bounds": icon_eu_tilejson_bounds,
-            "attribution": "<a href=\"https://www.dwd.de/EN/ourservices/nwp_forecast_data/nwp_forecast_data.html\" target=\"_blank\">Deutscher Wetterdienst</a>",
-        }
-        with open(os.path.join(hour_dir, "tilejson.json"), "w+") as f:
-            f.write(json.dumps(tilejson, indent=2))
+        fs = mv.Fieldset(path=data_file.path) * 100
+
+        grib_paths = []
+        for (i, area) in enumerate(areas):
+            grib_path = os.path.join(scratch_dir, f"{hour}_{i}.grib2")
+            if area == icon_eu_tilejson_bounds:
+                mv.write(grib_path, fs)
+            else:
+                mv.write(grib_path, util.crop(fs, area))
+            grib_paths.append(grib_path)
+
+        if len(grib_paths) == 1:
+            source_path = grib_paths[0]
+        else:
+            source_path = os.path.join(scratch_dir, f"{hour}.vrt")
+            util.mosaic(grib_paths, source_path)
+
+        util.archive.append("icon_eu_h_snow", "h_snow", run_ts, run_ts + timedelta(hours=data_file.step), source_path)
+
+        layer_url = "https://plantopo-weather.b-cdn.net/icon_eu_h_snow/" + run + "/" + hour
+        util.render_layer(
+            source_path,
+            "colormaps/snow_depth_cm.txt",
+            hour_dir,
+            layer_url=layer_url,
+            bounds=tilejson_bounds,
+            attribution=attribution,
+            scratch_dir=scratch_dir,
+            value_encoding=value_encoding,
+            journal=journal,
+            tile_filter=tile_filter,
+            layers=layers,
+            # the gaps between areas are transparent
+            exclude_transparent=len(grib_paths) > 1,
+        )
 
         hours.append({
             "hour": int(hour),
-            "tilejson": "https://plantopo-weather.b-cdn.net/icon_eu_h_snow/" + run + "/" + hour + "/tilejson.json",
+            "tilejson": layers.tilejson_url(layer_url),
         })
 
-    shutil.rmtree(data_dir)
+    shutil.rmtree(scratch_dir)
 
     meta = {
-        "modelRun": run_timestamp.isoformat() + "Z",
+        "modelRun": run_ts.isoformat() + "Z",
         "versionMessage": version_message,
         "hours": hours,
     }
+
+    if "atlas" in util.output_modes():
+        # every forecast hour of a tile in one image, for animating
+        util.render_atlas(
+            [os.path.join(run_dir, f"{h['hour']:03d}") for h in hours],
+            os.path.join(run_dir, "atlas"),
+            frames=[{"hour": h["hour"]} for h in hours],
+            layer_url="https://plantopo-weather.b-cdn.net/icon_eu_h_snow/" + run + "/atlas",
+            bounds=tilejson_bounds,
+            attribution=attribution,
+            journal=journal,
+        )
+        meta["atlasTilejson"] = "https://plantopo-weather.b-cdn.net/icon_eu_h_snow/" + run + "/atlas/tilejson.json"
     meta_path = os.path.join(out_dir, "meta.json")
     with open(meta_path, "w+") as f:
         f.write(json.dumps(meta, indent=2))
@@ -92,18 +139,16 @@ if __name__ == "__main__":
     with open(legend_path, "w+") as f:
         f.write(util.colormap.html_legend("colormaps/snow_depth_cm.txt"))
 
-    for root, _dirs, files in os.walk(run_dir):
-        for fname in files:
-            local_path = str(os.path.join(root, fname))
-            remote_path = local_path.replace(out_dir, "").strip("/")
-            bunny.weather_storage_upload(local_path, "icon_eu_h_snow/" + remote_path)
+    layers_path = os.path.join(out_dir, "layers.json")
+    layers.save(layers_path)
 
-    bunny.weather_storage_upload(meta_path, "icon_eu_h_snow/meta.json")
-    bunny.purge("https://plantopo-weather.b-cdn.net/icon_eu_h_snow/meta.json")
+    util.publish.publish("icon_eu_h_snow", run_dir, run, [meta_path, legend_path, layers_path], journal=journal)
 
-    bunny.weather_storage_upload(legend_path, "icon_eu_h_snow/legend.html")
-    bunny.purge("https://plantopo-weather.b-cdn.net/icon_eu_h_snow/legend.html")
+    print("All done!")
 
-    bunny.weather_storage_delete_old("icon_eu_h_snow/")
 
-    print("All done!")
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        main("/out")
+    else:
+        main(sys.argv[1])
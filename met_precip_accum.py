@@ -1,18 +1,25 @@
 #!/usr/bin/env python
 
+import functools
 import json
 import os
 import sys
 import tempfile
-from datetime import datetime, timedelta, timezone, time
-from glob import glob
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
 
 import dateutil
 import metview as mv
 import requests
 
+import util.archive
 import util.colormap
-from util import bunny
+import util.gribindex
+import util.heat
+import util.journal
+import util.publish
+import util.reuse
+import util.windows
 
 apiKey = os.getenv("MET_ATMOSPHERIC_API_KEY")
 
@@ -22,11 +29,37 @@ order = "plantopo-scotland-precip-accum"
 day_start_hour = 6
 day_end_hour = 18
 
-# See <https://datahub.metoffice.gov.uk/support/model-run-availability> for when to run this program
-expected_run_ts = datetime.combine(datetime.today(), time(hour=3), timezone.utc)
+# the furthest ahead the order goes
+max_forecast_days = 7
 
+# For the "encoded" output mode (mm/h, in steps of 0.001mm/h)
+value_encoding = util.encoded.Encoding(offset=0.0, scale=0.001)
 
-def download(out: str):
+
+def latest_run_ts() -> datetime:
+    # The order is updated with every model cycle, see <https://datahub.metoffice.gov.uk/support/model-run-availability>
+    resp = requests.get(
+        f"https://data.hub.api.metoffice.gov.uk/atmospheric-models/1.0.0/orders/{order}/latest?detail=minimal",
+        headers={"apikey": apiKey},
+        allow_redirects=True,
+    )
+    if resp.status_code != 200:
+        raise RuntimeError(f"got status {resp.status_code} requesting order data")
+
+    runs = {dateutil.parser.isoparse(file["runDateTime"]) for file in resp.json()["orderDetails"]["files"]}
+    # while the order is being updated it lists files from more than one run
+    if len(runs) != 1:
+        raise RuntimeError(f"order lists files from {len(runs)} runs, it's probably being updated")
+    return runs.pop()
+
+
+def download(
+        out: str,
+        expected_ts: datetime,
+        windows: list[util.windows.Window],
+        journal: util.journal.Journal,
+        on_file: Optional[Callable[[str], None]] = None,
+):
     resp = requests.get(
         f"https://data.hub.api.metoffice.gov.uk/atmospheric-models/1.0.0/orders/{order}/latest?detail=minimal",
         headers={"apikey": apiKey},
@@ -39,8 +72,8 @@ def download(out: str):
     for file in data["orderDetails"]["files"]:
         raw_run_ts = file["runDateTime"]
         run_ts = dateutil.parser.isoparse(raw_run_ts)
-        if run_ts != expected_run_ts:
-            raise RuntimeError(f"expected run not available: got {raw_run_ts}, expected {expected_run_ts}")
+        if run_ts != expected_ts:
+            raise RuntimeError(f"expected run not available: got {raw_run_ts}, expected {expected_ts}")
 
     to_download: list[str] = []
     for file in data["orderDetails"]["files"]:
@@ -49,130 +82,211 @@ def download(out: str):
         if "+" not in file_id:
             #  The order contains the same file in the relative and absolute naming format, so I only include absolute
             to_download.append(file_id)
+    to_download = util.windows.plan_downloads(to_download, windows)
 
     for (i, file_id) in enumerate(to_download):
-        print(f"Downloading {file_id} ({i + 1}/{len(to_download)})")
-        resp = requests.get(
-            f"https://data.hub.api.metoffice.gov.uk/atmospheric-models/1.0.0/orders/{order}/latest/{file_id}/data",
-            headers={"apikey": apiKey},
-            allow_redirects=True,
-        )
-        if resp.status_code != 200:
-            raise RuntimeError(f"got status {resp.status_code} downloading {file_id}")
-
-        with open(os.path.join(out, file_id), "wb") as f:
-            f.write(resp.content)
+        path = os.path.join(out, file_id)
+        if os.path.exists(path) and journal.is_done("download", file_id, util.journal.file_digest(path)):
+            print(f"Already downloaded {file_id} ({i + 1}/{len(to_download)})")
+        else:
+            print(f"Downloading {file_id} ({i + 1}/{len(to_download)})")
+            resp = requests.get(
+                f"https://data.hub.api.metoffice.gov.uk/atmospheric-models/1.0.0/orders/{order}/latest/{file_id}/data",
+                headers={"apikey": apiKey},
+                allow_redirects=True,
+            )
+            if resp.status_code != 200:
+                raise RuntimeError(f"got status {resp.status_code} downloading {file_id}")
+
+            with open(path, "wb") as f:
+                f.write(resp.content)
+            journal.record("download", file_id, util.journal.file_digest(path))
+
+        if on_file is not None:
+            on_file(path)
 
     print(f"Downloaded {len(to_download)} files")
 
 
-def accumulate_daytime(data_dir: str, out_dir: str) -> tuple[datetime, dict[datetime.date, str]]:
-    all_fs = mv.Fieldset(path=data_dir + "/*")
+def step_times(row) -> tuple[datetime, datetime, datetime]:
+    start_step = int(row["startStep"])
+    end_step = int(row["endStep"])
+
+    base_ts = datetime.strptime(f"{str(row['dataDate']).zfill(8)} {str(row['dataTime']).zfill(4)} UTC",
+                                "%Y%m%d %H%M %Z")
+    start_ts = base_ts + timedelta(hours=start_step)
+    end_ts = base_ts + timedelta(hours=end_step)
+    return base_ts, start_ts, end_ts
 
-    steps_by_date = {}
-    latest_base_ts = None
-    for (i, row) in all_fs.ls(no_print=True, extra_keys=["startStep", "endStep"]).iterrows():
-        start_step = int(row["startStep"])
-        end_step = int(row["endStep"])
 
-        base_ts = datetime.strptime(f"{str(row['dataDate']).zfill(8)} {str(row['dataTime']).zfill(4)} UTC",
-                                    "%Y%m%d %H%M %Z")
-        start_ts = base_ts + timedelta(hours=start_step)
-        end_ts = base_ts + timedelta(hours=end_step)
+def is_daytime(start_ts: datetime, end_ts: datetime) -> bool:
+    return start_ts.hour >= day_start_hour and end_ts.hour <= day_end_hour and start_ts.date() == end_ts.date()
 
-        if latest_base_ts is None or base_ts > latest_base_ts:
-            latest_base_ts = base_ts
 
-        if start_ts.hour >= day_start_hour and end_ts.hour <= day_end_hour and start_ts.date() == end_ts.date():
-            if start_ts.date() not in steps_by_date:
-                steps_by_date[start_ts.date()] = []
-            steps_by_date[start_ts.date()].append(row)
+def daytime_accumulation_end(hourly: util.gribindex.Selection, field: mv.Fieldset) -> Optional[datetime]:
+    # hourly accumulations only, as in accumulate_daytime
+    if hourly(field) is None:
+        return None
+    row = field.ls(no_print=True, extra_keys=["startStep", "endStep"]).iloc[0]
+    (_base_ts, start_ts, end_ts) = step_times(row)
+    if is_daytime(start_ts, end_ts):
+        return end_ts
+    return None
+
+
+def accumulate_daytime(
+        index: util.gribindex.GribIndex,
+        out_dir: str,
+) -> tuple[datetime, dict[datetime.date, tuple[str, bool]]]:
+    # base time, and for each date the accumulation's path and whether it has every hour of the day
+    messages_by_date = {}
+    # hourly accumulations only, as a longer one would count its hours twice
+    for m in index.select(period=1):
+        start_ts = m.data_ts + timedelta(hours=m.start_step)
+        end_ts = m.data_ts + timedelta(hours=m.end_step)
+        if is_daytime(start_ts, end_ts):
+            messages_by_date.setdefault(start_ts.date(), []).append(m)
 
     out = {}
-    for (date, steps) in steps_by_date.items():
-        fs = all_fs.select(startStep=[s["startStep"] for s in steps]).sum() / (day_end_hour - day_start_hour)
+    for (date, messages) in messages_by_date.items():
+        fields_path = os.path.join(out_dir, f"{date.strftime('%Y-%m-%d')}_fields.grib")
+        fs = index.fieldset(messages, fields_path).sum() / (day_end_hour - day_start_hour)
         out_path = os.path.join(out_dir, f"{date.strftime('%Y-%m-%d')}.grib")
         mv.write(out_path, fs)
-        out[date] = out_path
-    return latest_base_ts, out
+        hours = {m.data_ts + timedelta(hours=m.end_step) for m in messages}
+        out[date] = (out_path, len(hours) == day_end_hour - day_start_hour)
+    return max(m.data_ts for m in index.messages), out
 
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        out_dir = "/out"
-    else:
-        out_dir = sys.argv[1]
-    util.ensure_empty_dir(out_dir)
+def main(out_dir: str):
+    run_ts = latest_run_ts()
+    run_name = run_ts.strftime('%Y%m%d%H')
+
+    # accumulations are valid at the end of their period, as are the times in the order's file ids
+    windows = [util.windows.daytime(run_ts.date() + timedelta(days=d), day_start_hour + 1, day_end_hour)
+               for d in range(0, max_forecast_days)]
+
+    journal = util.journal.open_journal("met_scotland_daytime_average_precipitation_accumulation", run_name)
+    if not journal.resumed:
+        util.ensure_empty_dir(out_dir)
+
+    # above the always complete low zooms, only the tiles people request
+    tile_filter = util.heat.tile_filter("met_scotland_daytime_average_precipitation_accumulation")
+
+    # days that are unchanged since an earlier run, or that this run doesn't cover, keep that run's layers
+    layers = util.reuse.Layers.load("met_scotland_daytime_average_precipitation_accumulation", run_name)
+
+    def layer_url(d: datetime.date) -> str:
+        return ("https://plantopo-weather.b-cdn.net/met_scotland_daytime_average_precipitation_accumulation/" +
+                run_name + "/" + d.strftime('%Y%m%d'))
 
     with tempfile.TemporaryDirectory() as scratch_dir:
-        download_dir = os.path.join(scratch_dir, "download")
+        download_dir = journal.work_dir("download", scratch_dir)
         daytime_dir = os.path.join(scratch_dir, "daytime")
-        colorized_dir = os.path.join(scratch_dir, "colorized")
 
-        for d in [download_dir, daytime_dir, colorized_dir, out_dir]:
+        for d in [daytime_dir, out_dir]:
             os.makedirs(d, exist_ok=True)
 
-        download(download_dir)
-
-        (base_ts, daytime_files) = accumulate_daytime(download_dir, daytime_dir)
+        def render(date: datetime.date, daytime_grib: str, complete: bool):
+            if complete:
+                util.archive.append("met_scotland_daytime_average_precipitation_accumulation", "daytime_average",
+                                    run_ts, datetime(date.year, date.month, date.day, day_start_hour), daytime_grib)
+            elif layers.keep(layer_url(date)):
+                return
+            util.render_layer(
+                daytime_grib,
+                "colormaps/precip_mm_per_h.txt",
+                os.path.join(out_dir, date.strftime("%Y%m%d")),
+                layer_url=layer_url(date),
+                bounds=util.met_scotland_tilejson_bounds,
+                attribution=util.met_office_attribution,
+                scratch_dir=scratch_dir,
+                value_encoding=value_encoding,
+                journal=journal,
+                tile_filter=tile_filter,
+                layers=layers,
+                max_zoom=8,
+            )
+
+        if util.env_flag("STREAMING_REDUCTION"):
+            # reduce each day as its hours arrive instead of loading the whole order
+
+            def on_complete(acc: util.windows.Accumulator):
+                daytime_grib = os.path.join(daytime_dir, f"{acc.window.date.strftime('%Y-%m-%d')}.grib")
+                mv.write(daytime_grib, acc.sum() / (day_end_hour - day_start_hour))
+                render(acc.window.date, daytime_grib, acc.is_complete())
+
+            reducer = util.windows.StreamingReducer(windows, on_complete, validity_of=functools.partial(
+                daytime_accumulation_end, util.gribindex.Selection(period=1)))
+            download(download_dir, run_ts, windows, journal, on_file=reducer.fold_file)
+            reducer.finish()
+            base_ts = reducer.data_ts
+        else:
+            download(download_dir, run_ts, windows, journal)
+
+            index = util.gribindex.GribIndex.build(download_dir)
+            (base_ts, daytime_files) = accumulate_daytime(index, daytime_dir)
+            for date, (daytime_grib, complete) in sorted(daytime_files.items(), key=lambda v: v[0]):
+                render(date, daytime_grib, complete)
 
         dates = []
-        for date, daytime_grib in sorted(daytime_files.items(), key=lambda v: v[0]):
-            date_out_dir = os.path.join(out_dir, date.strftime("%Y%m%d"))
-            os.makedirs(date_out_dir, exist_ok=True)
-
-            colorized_tif = os.path.join(colorized_dir, f"{date.strftime('%Y%m%d')}.tif")
-            util.colorize(daytime_grib, "colormaps/precip_mm_per_h.txt", colorized_tif)
-
-            util.generate_tiles(colorized_tif, date_out_dir, max_zoom=8)
-
-            tilejson = {
-                "tiles": [
-                    f"https://plantopo-weather.b-cdn.net/met_scotland_daytime_average_precipitation_accumulation/" +
-                    base_ts.strftime('%Y%m%d') + "/" + date.strftime('%Y%m%d') + "/{z}/{x}/{y}.png"],
-                "minzoom": 1,
-                "maxzoom": 8,
-                "bounds": [-6.92, 54.51, -1.65, 58.78],
-                "attribution": "<a href=\"https://datahub.metoffice.gov.uk/\" target=\"_blank\">Met Office</a>",
-            }
-            with open(os.path.join(date_out_dir, "tilejson.json"), "w+") as f:
-                f.write(json.dumps(tilejson, indent=2))
-
-            dates.append({
-                "date": date.isoformat(),
-                "tilejson": "https://plantopo-weather.b-cdn.net/met_scotland_daytime_average_precipitation_accumulation/" +
-                            base_ts.strftime('%Y%m%d') + "/" + date.strftime('%Y%m%d') + "/tilejson.json",
-            })
+        layer_dates = []
+        for window in windows:
+            # days the run has no data for at all
+            if layers.tilejson_url(layer_url(window.date)) is None:
+                layers.keep(layer_url(window.date))
+
+            tilejson_url = layers.tilejson_url(layer_url(window.date))
+            if tilejson_url is not None:
+                dates.append({"date": window.date.isoformat(), "tilejson": tilejson_url})
+                layer_dates.append(window.date)
 
         versionMessage = f"Updated at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M')} UTC to the {base_ts.strftime('%Y-%m-%d %H:%M')} UTC model run"
+        meta = {
+            "modelRun": base_ts.isoformat() + "Z",
+            "dates": dates,
+            "versionMessage": versionMessage,
+        }
+
+        if "atlas" in util.output_modes():
+            # every date in one image per tile, for animating
+            atlas_url = "https://plantopo-weather.b-cdn.net/met_scotland_daytime_average_precipitation_accumulation/" + \
+                        run_name + "/atlas"
+            util.render_atlas(
+                [os.path.join(out_dir, d.strftime("%Y%m%d")) for d in layer_dates],
+                os.path.join(out_dir, "atlas"),
+                frames=[{"date": d.isoformat()} for d in layer_dates],
+                layer_url=atlas_url,
+                bounds=util.met_scotland_tilejson_bounds,
+                attribution=util.met_office_attribution,
+                journal=journal,
+                max_zoom=8,
+            )
+            meta["atlasTilejson"] = atlas_url + "/tilejson.json"
+
         with open(os.path.join(out_dir, "meta.json"), "w+") as f:
-            f.write(json.dumps({
-                "modelRun": base_ts.isoformat() + "Z",
-                "dates": dates,
-                "versionMessage": versionMessage,
-            }, indent=2))
+            f.write(json.dumps(meta, indent=2))
 
     legend_path = os.path.join(out_dir, "legend.html")
     with open(legend_path, "w+") as f:
         f.write(util.colormap.html_legend("colormaps/precip_mm_per_h.txt"))
 
-    for local_path in glob(f"{out_dir}/**/*", recursive=True):
-        if local_path.endswith("/meta.json") or local_path.endswith("/legend.html") or not os.path.isfile(local_path):
-            continue
-        remote_path = local_path.replace(out_dir, "").strip("/")
-        bunny.weather_storage_upload(
-            local_path,
-            "met_scotland_daytime_average_precipitation_accumulation/" + base_ts.strftime('%Y%m%d') + "/" + remote_path)
+    layers_path = os.path.join(out_dir, "layers.json")
+    layers.save(layers_path)
 
-    bunny.weather_storage_upload(os.path.join(out_dir, "meta.json"),
-                                 "met_scotland_daytime_average_precipitation_accumulation/meta.json")
-    bunny.purge("https://plantopo-weather.b-cdn.net/met_scotland_daytime_average_precipitation_accumulation/meta.json")
+    util.publish.publish(
+        "met_scotland_daytime_average_precipitation_accumulation",
+        out_dir,
+        run_name,
+        [os.path.join(out_dir, "meta.json"), legend_path, layers_path],
+        journal=journal,
+    )
 
-    bunny.weather_storage_upload(os.path.join(out_dir, "legend.html"),
-                                 "met_scotland_daytime_average_precipitation_accumulation/legend.html")
-    bunny.purge(
-        "https://plantopo-weather.b-cdn.net/met_scotland_daytime_average_precipitation_accumulation/legend.html")
+    print("All done!")
 
-    bunny.weather_storage_delete_old("met_scotland_daytime_average_precipitation_accumulation/")
 
-    print("All done!")
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        main("/out")
+    else:
+        main(sys.argv[1])
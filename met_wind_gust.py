@@ -4,14 +4,21 @@ import json
 import os
 import sys
 import tempfile
-from datetime import datetime, timedelta, timezone, time
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Optional
 
 import dateutil
 import metview as mv
 import requests
 
+import util.archive
 import util.colormap
-from util import bunny
+import util.gribindex
+import util.heat
+import util.journal
+import util.publish
+import util.reuse
+import util.windows
 
 apiKey = os.getenv("MET_ATMOSPHERIC_API_KEY")
 
@@ -22,15 +29,37 @@ day_start_hour = 6
 day_end_hour = 18
 day_hour_times = [h * 100 for h in range(day_start_hour, day_end_hour + 1)]
 
-# See <https://datahub.metoffice.gov.uk/support/model-run-availability> for when to run this program
-expected_run_ts = datetime.combine(datetime.today(), time(hour=3), timezone.utc)
-daytime_validity_dates = [expected_run_ts.date() + timedelta(days=d) for d in range(0, 5)]
-nighttime_validity_dates = [expected_run_ts.date() + timedelta(days=d) for d in range(0, 4)]
+
+def latest_run_ts() -> datetime:
+    # The order is updated with every model cycle, see <https://datahub.metoffice.gov.uk/support/model-run-availability>
+    resp = requests.get(
+        f"https://data.hub.api.metoffice.gov.uk/atmospheric-models/1.0.0/orders/{order}/latest?detail=minimal",
+        headers={"apikey": apiKey},
+        allow_redirects=True,
+    )
+    if resp.status_code != 200:
+        raise RuntimeError(f"got status {resp.status_code} requesting order data")
+
+    runs = {dateutil.parser.isoparse(file["runDateTime"]) for file in resp.json()["orderDetails"]["files"]}
+    # while the order is being updated it lists files from more than one run
+    if len(runs) != 1:
+        raise RuntimeError(f"order lists files from {len(runs)} runs, it's probably being updated")
+    return runs.pop()
+
 
 meters_per_second_to_miles_per_hour_factor = 2.237
 
+# For the "encoded" output mode (mph, in steps of 0.01mph)
+value_encoding = util.encoded.Encoding(offset=0.0, scale=0.01)
+
 
-def download(out: str):
+def download(
+        out: str,
+        expected_ts: datetime,
+        windows: list[util.windows.Window],
+        journal: util.journal.Journal,
+        on_file: Optional[Callable[[str], None]] = None,
+):
     resp = requests.get(
         f"https://data.hub.api.metoffice.gov.uk/atmospheric-models/1.0.0/orders/{order}/latest?detail=minimal",
         headers={"apikey": apiKey},
@@ -43,8 +72,8 @@ def download(out: str):
     for file in data["orderDetails"]["files"]:
         raw_run_ts = file["runDateTime"]
         run_ts = dateutil.parser.isoparse(raw_run_ts)
-        if run_ts != expected_run_ts:
-            raise RuntimeError(f"expected run not available: got {raw_run_ts}, expected {expected_run_ts}")
+        if run_ts != expected_ts:
+            raise RuntimeError(f"expected run not available: got {raw_run_ts}, expected {expected_ts}")
 
     to_download: list[str] = []
     for file in data["orderDetails"]["files"]:
@@ -53,163 +82,183 @@ def download(out: str):
         if "+" not in file_id:
             #  The order contains the same file in the relative and absolute naming format, so I only include absolute
             to_download.append(file_id)
+    to_download = util.windows.plan_downloads(to_download, windows)
 
     for (i, file_id) in enumerate(to_download):
-        print(f"Downloading {file_id} ({i + 1}/{len(to_download)})")
-        resp = requests.get(
-            f"https://data.hub.api.metoffice.gov.uk/atmospheric-models/1.0.0/orders/{order}/latest/{file_id}/data",
-            headers={"apikey": apiKey},
-            allow_redirects=True,
-        )
-        if resp.status_code != 200:
-            raise RuntimeError(f"got status {resp.status_code} downloading {file_id}")
-
-        with open(os.path.join(out, file_id), "wb") as f:
-            f.write(resp.content)
+        path = os.path.join(out, file_id)
+        if os.path.exists(path) and journal.is_done("download", file_id, util.journal.file_digest(path)):
+            print(f"Already downloaded {file_id} ({i + 1}/{len(to_download)})")
+        else:
+            print(f"Downloading {file_id} ({i + 1}/{len(to_download)})")
+            resp = requests.get(
+                f"https://data.hub.api.metoffice.gov.uk/atmospheric-models/1.0.0/orders/{order}/latest/{file_id}/data",
+                headers={"apikey": apiKey},
+                allow_redirects=True,
+            )
+            if resp.status_code != 200:
+                raise RuntimeError(f"got status {resp.status_code} downloading {file_id}")
+
+            with open(path, "wb") as f:
+                f.write(resp.content)
+            journal.record("download", file_id, util.journal.file_digest(path))
+
+        if on_file is not None:
+            on_file(path)
 
     print(f"Downloaded {len(to_download)} files")
 
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        out_dir = "/out"
-    else:
-        out_dir = sys.argv[1]
-    util.ensure_empty_dir(out_dir)
-
-    with tempfile.TemporaryDirectory() as scratch_dir:
-        download_dir = os.path.join(scratch_dir, "download")
-        grib_dir = os.path.join(scratch_dir, "grib")
-        colorized_dir = os.path.join(scratch_dir, "colorized")
-
-        for d in [download_dir, grib_dir, colorized_dir, out_dir]:
-            os.makedirs(d, exist_ok=True)
-
-        download(download_dir)
-
-        all_fs = mv.Fieldset(path=f"{download_dir}/*")
-        data_ts = util.fieldset_data_datetime(all_fs)
-
-        run_name = data_ts.strftime("%Y%m%d")
-        run_dir = os.path.join(out_dir, run_name)
+def main(out_dir: str):
+    run_ts = latest_run_ts()
+    daytime_validity_dates = [run_ts.date() + timedelta(days=d) for d in range(0, 5)]
+    nighttime_validity_dates = [run_ts.date() + timedelta(days=d) for d in range(0, 4)]
 
-        for d in daytime_validity_dates:
-            date_name = d.strftime("%Y%m%d")
-            date_out_dir = os.path.join(run_dir, date_name)
+    windows = ([util.windows.daytime(d, day_start_hour, day_end_hour) for d in daytime_validity_dates] +
+               [util.windows.nighttime(d, day_start_hour, day_end_hour) for d in nighttime_validity_dates])
 
-            select_times = [h * 100 for h in range(day_start_hour, day_end_hour + 1)]
-            daytime_fs = all_fs.select(validityDate=d, validityTime=select_times)
-            print(f"selected fieldset where date={d}, time={select_times}")
-            daytime_fs.ls(extra_keys=["validityDate", "validityTime"])
+    run_name = run_ts.strftime("%Y%m%d%H")
+    run_dir = os.path.join(out_dir, run_name)
 
-            name = "daytime_max"
-            fs = daytime_fs.max() * meters_per_second_to_miles_per_hour_factor
+    journal = util.journal.open_journal("met_scotland_wind_gust", run_name)
+    if not journal.resumed:
+        util.ensure_empty_dir(out_dir)
 
-            name_out_dir = os.path.join(date_out_dir, name)
-            os.makedirs(name_out_dir, exist_ok=True)
+    # above the always complete low zooms, only the tiles people request
+    tile_filter = util.heat.tile_filter("met_scotland_wind_gust")
 
-            grib_file = os.path.join(grib_dir, f"{date_name}_{name}.grib")
-            mv.write(grib_file, fs)
+    # windows that are unchanged since an earlier run, or that this run doesn't cover, keep that run's layers
+    layers = util.reuse.Layers.load("met_scotland_wind_gust", run_name)
 
-            colorized_tif = os.path.join(colorized_dir, f"{date_name}_{name}.tif")
-            util.colorize(grib_file, "colormaps/wind_mph.txt", colorized_tif)
+    def layer_url(d: date, name: str) -> str:
+        return ("https://plantopo-weather.b-cdn.net/met_scotland_wind_gust/" + run_name + "/" + d.strftime("%Y%m%d") + "/" +
+                name)
 
-            util.generate_tiles(colorized_tif, name_out_dir, max_zoom=8)
-
-            tilejson = {
-                "tiles": [
-                    f"https://plantopo-weather.b-cdn.net/met_scotland_wind_gust/" + run_name + "/" + date_name +
-                    "/" + name + "/{z}/{x}/{y}.png"],
-                "minzoom": 1,
-                "maxzoom": 8,
-                "bounds": [-6.92, 54.51, -1.65, 58.78],
-                "attribution": "<a href=\"https://datahub.metoffice.gov.uk/\" target=\"_blank\">Met Office</a>",
-            }
-            with open(os.path.join(name_out_dir, "tilejson.json"), "w+") as f:
-                f.write(json.dumps(tilejson, indent=2))
-
-        for d in nighttime_validity_dates:
-            date_name = d.strftime("%Y%m%d")
-            date_out_dir = os.path.join(run_dir, date_name)
-
-            fs1_date = d
-            fs1_select_times = [h * 100 for h in range(day_end_hour + 1, 24)]
-
-            fs2_date = d + timedelta(days=1)
-            fs2_select_times = [h * 100 for h in range(0, day_start_hour)]
-
-            nighttime_fs = mv.merge(all_fs.select(validityDate=fs1_date, validityTime=fs1_select_times),
-                                    all_fs.select(validityDate=fs2_date, validityTime=fs2_select_times))
-            print(f"selected fieldset where date={fs1_date} and time={fs1_select_times} " +
-                  f"or date={fs2_date} and time={fs2_select_times}")
-            nighttime_fs.ls(extra_keys=["validityDate", "validityTime"])
-
-            name = "nighttime_max"
-            fs = nighttime_fs.max() * meters_per_second_to_miles_per_hour_factor
-
-            name_out_dir = os.path.join(date_out_dir, name)
-            os.makedirs(name_out_dir, exist_ok=True)
-
-            grib_file = os.path.join(grib_dir, f"{date_name}_{name}.grib")
-            mv.write(grib_file, fs)
-
-            colorized_tif = os.path.join(colorized_dir, f"{date_name}_{name}.tif")
-            util.colorize(grib_file, "colormaps/wind_mph.txt", colorized_tif)
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        download_dir = journal.work_dir("download", scratch_dir)
+        grib_dir = os.path.join(scratch_dir, "grib")
 
-            util.generate_tiles(colorized_tif, name_out_dir, max_zoom=8)
+        for d in [grib_dir, out_dir]:
+            os.makedirs(d, exist_ok=True)
 
-            tilejson = {
-                "tiles": [
-                    f"https://plantopo-weather.b-cdn.net/met_scotland_wind_gust/" + run_name + "/" + date_name +
-                    "/" + name + "/{z}/{x}/{y}.png"],
-                "minzoom": 1,
-                "maxzoom": 8,
-                "bounds": [-6.92, 54.51, -1.65, 58.78],
-                "attribution": "<a href=\"https://datahub.metoffice.gov.uk/\" target=\"_blank\">Met Office</a>",
-            }
-            with open(os.path.join(name_out_dir, "tilejson.json"), "w+") as f:
-                f.write(json.dumps(tilejson, indent=2))
+        def render(window: util.windows.Window, reduced: list[tuple[str, mv.Fieldset]], complete: bool):
+            date_name = window.date.strftime("%Y%m%d")
+            for (stat, fs) in reduced:
+                name = f"{window.name}_{stat}"
+                if not complete and layers.keep(layer_url(window.date, name)):
+                    continue
+
+                grib_file = os.path.join(grib_dir, f"{date_name}_{name}.grib")
+                mv.write(grib_file, fs)
+                if complete:
+                    util.archive.append("met_scotland_wind_gust", name, run_ts, min(window.validity), grib_file)
+
+                util.render_layer(
+                    grib_file,
+                    "colormaps/wind_mph.txt",
+                    os.path.join(run_dir, date_name, name),
+                    layer_url=layer_url(window.date, name),
+                    bounds=util.met_scotland_tilejson_bounds,
+                    attribution=util.met_office_attribution,
+                    scratch_dir=scratch_dir,
+                    value_encoding=value_encoding,
+                    journal=journal,
+                    tile_filter=tile_filter,
+                    layers=layers,
+                    max_zoom=8,
+                )
+
+        if util.env_flag("STREAMING_REDUCTION"):
+            # reduce each window as its hours arrive instead of loading the whole order
+            reducer = util.windows.StreamingReducer(windows, lambda acc: render(
+                acc.window, [("max", acc.max() * meters_per_second_to_miles_per_hour_factor)], acc.is_complete()),
+                # the same fields as the index selects below
+                validity_of=util.gribindex.Selection())
+            download(download_dir, run_ts, windows, journal, on_file=reducer.fold_file)
+            reducer.finish()
+            data_ts = reducer.data_ts
+        else:
+            download(download_dir, run_ts, windows, journal)
+
+            index = util.gribindex.GribIndex.build(download_dir)
+            data_ts = index.data_datetime()
+
+            for window in windows:
+                messages = index.at(window.validity)
+                if len(messages) == 0:
+                    continue
+                window_fs = index.fieldset(
+                    messages,
+                    os.path.join(grib_dir, f"{window.date.strftime('%Y%m%d')}_{window.name}_fields.grib"),
+                )
+                complete = {m.validity for m in messages}.issuperset(window.validity)
+                render(window, [("max", window_fs.max() * meters_per_second_to_miles_per_hour_factor)], complete)
+
+        # windows the run has no data for at all
+        for window in windows:
+            for stat in ["max"]:
+                url = layer_url(window.date, f"{window.name}_{stat}")
+                if layers.tilejson_url(url) is None:
+                    layers.keep(url)
 
     # nighttime dates are a subset of daytime dates
     dates = []
     for d in daytime_validity_dates:
-        date_url = "https://plantopo-weather.b-cdn.net/met_scotland_wind_gust/" + run_name + "/" + \
-                   d.strftime('%Y%m%d')
-
-        date_meta = {
-            "date": d.isoformat(),
-            "daytime_max_tilejson": date_url + "/daytime_max/tilejson.json",
-        }
-
-        if d in nighttime_validity_dates:
-            date_meta["nighttime_max_tilejson"] = date_url + "/nighttime_max/tilejson.json"
+        date_meta = {"date": d.isoformat()}
+        for window_name in ["daytime", "nighttime"]:
+            for stat in ["max"]:
+                tilejson_url = layers.tilejson_url(layer_url(d, f"{window_name}_{stat}"))
+                if tilejson_url is not None:
+                    date_meta[f"{window_name}_{stat}_tilejson"] = tilejson_url
 
-        dates.append(date_meta)
+        # such as today after a late cycle, when no earlier run covered it
+        if "daytime_max_tilejson" in date_meta:
+            dates.append(date_meta)
 
     versionMessage = f"Updated at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M')} UTC to the {data_ts.strftime('%Y-%m-%d %H:%M')} UTC model run"
+    meta = {
+        "modelRun": data_ts.isoformat() + "Z",
+        "dates": dates,
+        "versionMessage": versionMessage,
+    }
+
+    if "atlas" in util.output_modes():
+        # every date of a layer in one image per tile, for animating
+        meta["atlasTilejsons"] = {}
+        for (window_name, window_dates) in [("daytime", daytime_validity_dates), ("nighttime", nighttime_validity_dates)]:
+            for stat in ["max"]:
+                name = f"{window_name}_{stat}"
+                atlas_url = "https://plantopo-weather.b-cdn.net/met_scotland_wind_gust/" + run_name + "/atlas/" + name
+                util.render_atlas(
+                    [os.path.join(run_dir, d.strftime("%Y%m%d"), name) for d in window_dates],
+                    os.path.join(run_dir, "atlas", name),
+                    frames=[{"date": d.isoformat()} for d in window_dates],
+                    layer_url=atlas_url,
+                    bounds=util.met_scotland_tilejson_bounds,
+                    attribution=util.met_office_attribution,
+                    journal=journal,
+                    max_zoom=8,
+                )
+                meta["atlasTilejsons"][name] = atlas_url + "/tilejson.json"
+
     meta_path = os.path.join(out_dir, "meta.json")
     with open(meta_path, "w+") as f:
-        f.write(json.dumps({
-            "modelRun": data_ts.isoformat() + "Z",
-            "dates": dates,
-            "versionMessage": versionMessage,
-        }, indent=2))
+        f.write(json.dumps(meta, indent=2))
 
     legend_path = os.path.join(out_dir, "legend.html")
     with open(legend_path, "w+") as f:
         f.write(util.colormap.html_legend("colormaps/wind_mph.txt"))
 
-    for root, _dirs, files in os.walk(run_dir):
-        for fname in files:
-            local_path = str(os.path.join(root, fname))
-            remote_path = local_path.replace(out_dir, "").strip("/")
-            bunny.weather_storage_upload(local_path, "met_scotland_wind_gust/" + remote_path)
-
-    for entry in os.scandir(out_dir):
-        if entry.is_file():
-            bunny.weather_storage_upload(entry.path, "met_scotland_wind_gust/" + entry.name)
-            bunny.purge("https://plantopo-weather.b-cdn.net/met_scotland_wind_gust/" + entry.name)
+    layers_path = os.path.join(out_dir, "layers.json")
+    layers.save(layers_path)
 
-    bunny.weather_storage_delete_old("met_scotland_wind_gust/")
+    util.publish.publish("met_scotland_wind_gust", run_dir, run_name, [meta_path, legend_path, layers_path],
+                         journal=journal)
 
     print("All done!")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        main("/out")
+    else:
+        main(sys.argv[1])
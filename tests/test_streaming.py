@@ -0,0 +1,93 @@
+import datetime
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+import util.gribindex
+import util.windows
+
+run_ts = datetime.datetime(2025, 6, 15, 0)
+day = datetime.date(2025, 6, 15)
+
+
+class FakeField:
+    def __init__(self, param: str, start_step: int, end_step: int, value: float):
+        self.row = {
+            "shortName": param,
+            "dataDate": 20250615,
+            "dataTime": 0,
+            "startStep": start_step,
+            "endStep": end_step,
+            "validityDate": 20250615,
+            "validityTime": end_step * 100,
+        }
+        self.value = value
+
+    def ls(self, no_print=True, extra_keys=None):
+        return SimpleNamespace(iloc=[self.row])
+
+    def values(self) -> np.ndarray:
+        return np.full((2, 2), self.value, dtype=np.float32)
+
+    def set_values(self, values: np.ndarray) -> np.ndarray:
+        return values
+
+
+class FakeFieldset(list):
+    def ls(self, no_print=True):
+        return SimpleNamespace(dataDate=[f.row["dataDate"] for f in self], dataTime=[f.row["dataTime"] for f in self])
+
+
+def mixed_period_file() -> FakeFieldset:
+    # like an order with each hour's temperature next to the maximum over the hour, and a three hour accumulation
+    fields = FakeFieldset()
+    for hour in range(6, 9):
+        fields.append(FakeField("t", hour, hour, hour))
+        fields.append(FakeField("mx", hour - 1, hour, 100 + hour))
+    fields.append(FakeField("mx", 5, 8, 1000))
+    return fields
+
+
+def reduce(validity_of) -> dict[str, util.windows.Accumulator]:
+    out = {}
+    reducer = util.windows.StreamingReducer(
+        [util.windows.daytime(day, 6, 8)], lambda acc: out.setdefault(acc.window.name, acc), validity_of=validity_of)
+    with mock.patch.object(util.windows.mv, "Fieldset", lambda path: mixed_period_file(), create=True):
+        reducer.fold_file("mixed.grib")
+    reducer.finish()
+    return out
+
+
+class StreamingSelectionTest(unittest.TestCase):
+    def test_instantaneous(self):
+        acc = reduce(util.gribindex.Selection(period=0))["daytime"]
+        self.assertTrue(acc.is_complete())
+        self.assertEqual(acc.max()[0, 0], 8)
+        self.assertEqual(acc.min()[0, 0], 6)
+
+    def test_hourly(self):
+        acc = reduce(util.gribindex.Selection(period=1))["daytime"]
+        self.assertEqual(acc.sum()[0, 0], 106 + 107 + 108)
+
+    def test_same_as_index(self):
+        messages = [
+            util.gribindex.Message("mixed.grib", i, 1, f.row["shortName"], run_ts,
+                                   run_ts + datetime.timedelta(hours=f.row["endStep"]), f.row["startStep"],
+                                   f.row["endStep"])
+            for (i, f) in enumerate(mixed_period_file())
+        ]
+        index = util.gribindex.GribIndex("", messages)
+        window = util.windows.daytime(day, 6, 8)
+        for period in [0, 1]:
+            acc = reduce(util.gribindex.Selection(period=period))["daytime"]
+            self.assertEqual(acc.seen, {m.validity for m in index.at(window.validity, period=period)})
+
+    def test_ambiguous(self):
+        with self.assertRaises(RuntimeError):
+            reduce(util.gribindex.Selection())
+
+
+if __name__ == "__main__":
+    unittest.main()
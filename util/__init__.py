@@ -1,34 +1,65 @@
 import datetime
+import json
 import os
 import shutil
-import subprocess
 import tempfile
+from typing import Optional
 
 import metview as mv
+from osgeo import gdal
 
+from util import atlas, encoded, heat, isobands, reuse, shards, tiler, valuegrid
 from util.colormap import Colormap
+from util.journal import Journal, file_digest, tree_digest
+
+gdal.UseExceptions()
 
 # 23.5°W–45.0°E, 29.5°N–70.5°N (https://www.dwd.de/EN/ourservices/nwp_forecast_data/nwp_forecast_data.html)
 # left, bottom, right, top
 icon_eu_tilejson_bounds = [-23.5, 29.5, 45.0, 70.5]
 
+# left, bottom, right, top
+met_scotland_tilejson_bounds = [-6.92, 54.51, -1.65, 58.78]
 
-def colorize(source_path: str, colormap_path: str, output_path: str):
-    cmap = Colormap.read(colormap_path)
+met_office_attribution = "<a href=\"https://datahub.metoffice.gov.uk/\" target=\"_blank\">Met Office</a>"
+
+
+def parse_areas(source: Optional[str]) -> list[list[float]]:
+    # "left,bottom,right,top;left,bottom,right,top"
+    if source is None or source.strip() == "":
+        return []
+
+    areas = []
+    for part in source.split(";"):
+        if part.strip() == "":
+            continue
+        bounds = [float(v) for v in part.split(",")]
+        if len(bounds) != 4 or bounds[0] >= bounds[2] or bounds[1] >= bounds[3]:
+            raise RuntimeError(f"invalid area {part!r}, expected left,bottom,right,top")
+        areas.append(bounds)
+    return areas
 
-    with tempfile.NamedTemporaryFile() as colormap_scratch:
-        colormap_scratch.write(cmap.gdal_format().encode("utf8"))
-        colormap_scratch.flush()
 
-        subprocess.run([
-            "gdaldem",
-            "color-relief",
-            "-alpha",
-            "-nearest_color_entry",
-            source_path,
-            colormap_scratch.name,
-            output_path,
-        ])
+def intersect_bounds(a: list[float], b: list[float]) -> Optional[list[float]]:
+    out = [max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])]
+    if out[0] >= out[2] or out[1] >= out[3]:
+        return None
+    return out
+
+
+def union_bounds(areas: list[list[float]]) -> list[float]:
+    return [
+        min(a[0] for a in areas),
+        min(a[1] for a in areas),
+        max(a[2] for a in areas),
+        max(a[3] for a in areas),
+    ]
+
+
+def crop(fs: mv.Fieldset, bounds: list[float]) -> mv.Fieldset:
+    left, bottom, right, top = bounds
+    # metview expects the area as north/west/south/east
+    return mv.read(data=fs, area=[top, left, bottom, right])
 
 
 def generate_tiles(
@@ -37,21 +68,215 @@ def generate_tiles(
         *,
         min_zoom=1,
         max_zoom=5,
+        exclude_transparent=False,
+        tile_filter: Optional[tiler.TileFilter] = None,
 ):
-    subprocess.run([
-        "gdal2tiles.py",
-        "--zoom=" + str(min_zoom) + "-" + str(max_zoom),
-        "--resampling=near",  # since we have categorical data
-        "--tilesize=512",  # the modern default
-        "--xyz",  # the modern default
-        "--webviewer=none",
-        input_path,
+    tiler.generate_tiles(input_path, output_path, min_zoom=min_zoom, max_zoom=max_zoom,
+                         exclude_transparent=exclude_transparent, tile_filter=tile_filter)
+
+
+def mosaic(input_paths: list[str], output_path: str):
+    # areas not covered by any input are nodata, so they are transparent once colorized
+    ds = gdal.BuildVRT(output_path, input_paths, VRTNodata=-9999)
+    ds = None  # flush to disk
+
+
+def env_flag(name: str) -> bool:
+    return os.getenv(name, "").strip().lower() in ("1", "true", "yes")
+
+
+def output_modes() -> set[str]:
+    # Comma separated, for example "raster,isobands". "raster" tiles are always written as meta.json refers to them.
+    modes = {m.strip() for m in os.getenv("OUTPUT_MODES", "").split(",") if m.strip() != ""}
+    return modes | {"raster"}
+
+
+def render_layer(
+        source_path: str,
+        colormap_path: str,
+        out_dir: str,
+        *,
+        layer_url: str,
+        bounds: list[float],
+        attribution: str,
+        scratch_dir: str,
+        value_encoding: encoded.Encoding,
+        journal: Optional[Journal] = None,
+        min_zoom=1,
+        max_zoom=5,
+        exclude_transparent=False,
+        tile_filter: Optional[tiler.TileFilter] = None,
+        layers: Optional[reuse.Layers] = None,
+) -> dict:
+    # Renders a reduced field into out_dir in every enabled output mode. The raster tiles and their tilejson.json go
+    # directly in out_dir, other modes each get a subdirectory with their own tilejson.json or a single file.
+    # tile_filter limits which raster tiles are written, see util/heat.py. When sharded only this shard's share is
+    # rendered, see util/shards.py. With layers nothing is rendered if an earlier run's layer can be reused, see
+    # util/reuse.py, and the returned tilejson is that layer's.
+    key = None
+    if layers is not None:
+        key = reuse.layer_key(source_path, value_encoding, {
+            "colormap": file_digest(colormap_path),
+            "encoding": list(value_encoding),
+            "min_zoom": min_zoom,
+            "max_zoom": max_zoom,
+            "exclude_transparent": exclude_transparent,
+            "bounds": bounds,
+            "attribution": attribution,
+        })
+
+    tilejson_path = os.path.join(out_dir, "tilejson.json")
+    if journal is not None and journal.is_done("layer", out_dir, tree_digest(out_dir)):
+        print(f"Already rendered {out_dir}")
+        with open(tilejson_path, "r") as f:
+            tilejson = json.load(f)
+        if layers is not None:
+            layers.record(layer_url, key, tilejson)
+        return tilejson
+
+    if layers is not None:
+        reused = layers.reuse(layer_url, key)
+        if reused is not None:
+            return reused
+
+    modes = output_modes()
+    if shards.is_sharded() and not shards.owns_layer(layer_url):
+        # another shard renders the modes that aren't split by tile
+        modes -= {"isobands", "values", "cog"}
+    tile_filter = shards.tile_filter(tile_filter)
+    layer_scratch_dir = tempfile.mkdtemp(dir=scratch_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    cmap = Colormap.read(colormap_path)
+    if env_flag("CLASSIFIED_TILES"):
+        # a byte per pixel from the start, colored by the PNG's palette
+        compiled = cmap.compile()
+        tiler.generate_classified_tiles(source_path, compiled.classify, compiled.palette(), out_dir,
+                                        min_zoom=min_zoom, max_zoom=max_zoom,
+                                        exclude_transparent=exclude_transparent, tile_filter=tile_filter)
+    else:
+        tiler.generate_colorized_tiles(source_path, cmap.compile().apply, out_dir, min_zoom=min_zoom,
+                                       max_zoom=max_zoom, exclude_transparent=exclude_transparent,
+                                       tile_filter=tile_filter)
+
+    tilejson = {
+        "tiles": [layer_url + "/{z}/{x}/{y}.png"],
+        "minzoom": min_zoom,
+        "maxzoom": max_zoom,
+        "bounds": bounds,
+        "attribution": attribution,
+    }
+    write_json(tilejson_path, tilejson)
+
+    if "isobands" in modes:
+        isobands_dir = os.path.join(out_dir, "isobands")
+        isobands_tilejson = isobands.generate_tiles(source_path, colormap_path, isobands_dir,
+                                                    scratch_dir=layer_scratch_dir,
+                                                    min_zoom=min_zoom, max_zoom=max_zoom)
+        write_json(os.path.join(isobands_dir, "tilejson.json"), {
+            "tiles": [layer_url + "/isobands/{z}/{x}/{y}.pbf"],
+            **isobands_tilejson,
+            "bounds": bounds,
+            "attribution": attribution,
+        })
+
+    if "encoded" in modes:
+        encoded_tif = os.path.join(layer_scratch_dir, "encoded.tif")
+        encoded.write_encoded(source_path, encoded_tif, value_encoding)
+
+        encoded_dir = os.path.join(out_dir, "encoded")
+        generate_tiles(encoded_tif, encoded_dir, min_zoom=min_zoom, max_zoom=max_zoom,
+                       exclude_transparent=exclude_transparent, tile_filter=tile_filter)
+        write_json(os.path.join(encoded_dir, "tilejson.json"), {
+            "tiles": [layer_url + "/encoded/{z}/{x}/{y}.png"],
+            "minzoom": min_zoom,
+        "maxzoom": max_zoom,
+            "bounds": bounds,
+            "attribution": attribution,
+            "encoding": value_encoding.tilejson(),
+            "units": cmap.units,
+            # clients should pick the nearest stop to match the colored tiles
+            "colormap": cmap.legend(),
+        })
+
+    if "values" in modes:
+        # see util/valuegrid.py for the format
+        valuegrid.write(source_path, os.path.join(out_dir, "values.bin"))
+
+    if "cog" in modes:
+        write_cog(source_path, os.path.join(out_dir, "field.tif"))
+
+    shutil.rmtree(layer_scratch_dir)
+    if journal is not None:
+        journal.record("layer", out_dir, tree_digest(out_dir))
+    if layers is not None:
+        layers.record(layer_url, key, tilejson)
+    return tilejson
+
+
+def render_atlas(
+        frame_dirs: list[str],
+        out_dir: str,
+        *,
+        frames: list[dict],
+        layer_url: str,
+        bounds: list[float],
+        attribution: str,
+        journal: Optional[Journal] = None,
+        min_zoom=1,
+        max_zoom=5,
+) -> dict:
+    # Packs the raster tiles of layers rendered by render_layer into one atlas per tile, see util/atlas.py. frames
+    # describes each layer in order, for example its date or forecast hour, and goes in the tilejson. min_zoom and
+    # max_zoom are the layers' own, as a shard only has the tiles it rendered.
+    tilejson_path = os.path.join(out_dir, "tilejson.json")
+    if journal is not None and journal.is_done("layer", out_dir, tree_digest(out_dir)):
+        print(f"Already rendered {out_dir}")
+        with open(tilejson_path, "r") as f:
+            return json.load(f)
+
+    os.makedirs(out_dir, exist_ok=True)
+    atlas.write_atlas(frame_dirs, out_dir)
+
+    tilejson = {
+        "tiles": [layer_url + "/{z}/{x}/{y}.png"],
+        "minzoom": min_zoom,
+        "maxzoom": max_zoom,
+        "bounds": bounds,
+        "attribution": attribution,
+        "tile_size": tiler.tile_size,
+        # frame i is the tile_size tall band starting at y = i * tile_size
+        "frames": frames,
+    }
+    write_json(tilejson_path, tilejson)
+
+    if journal is not None:
+        journal.record("layer", out_dir, tree_digest(out_dir))
+    return tilejson
+
+
+def write_cog(source_path: str, output_path: str):
+    # Cloud-Optimized GeoTIFF of the field in its native grid, so readers can fetch just the windows and overview
+    # levels they need
+    ds = gdal.Translate(
         output_path,
-    ], check=True)
+        source_path,
+        format="COG",
+        outputType=gdal.GDT_Float32,
+        creationOptions=[
+            "COMPRESS=DEFLATE",
+            "PREDICTOR=YES",
+            "BLOCKSIZE=256",
+            "OVERVIEWS=AUTO",
+            "OVERVIEW_RESAMPLING=NEAREST",
+        ],
+    )
+    ds = None  # flush to disk
 
 
-def downloader_dwd(*args):
-    subprocess.run(["downloader_dwd", *args], check=True)
+def write_json(path: str, value):
+    with open(path, "w+") as f:
+        f.write(json.dumps(value, indent=2))
 
 
 def ensure_empty_dir(d: str):
@@ -0,0 +1,170 @@
+# Archive of every run's reduced fields, for time series across runs such as verification, climatology or how the
+# forecast for a day evolved.
+#
+# With ARCHIVE_DIR set, each product appends the fields it renders to a Zarr store at ARCHIVE_DIR/<product>.zarr. The
+# store has a group per variable (the layer name without its date, like daytime_max) holding
+#
+#   values (record, lat, lon) float32, NaN for no data, on a regular lon/lat grid like util/valuegrid.py's, chunked
+#     time_chunk records by space_chunk pixels square so a point or small area only reads the chunks it falls in
+#   run (record,) the model run, and valid (record,) the time the field is valid from, both seconds since the epoch
+#
+# and the grid's west, north, lon_step and lat_step as attributes, along with length, the number of records. A record
+# is written to all three arrays before length counts it, so anything past length is from an append that didn't
+# finish, and is ignored until the next append overwrites it. Archiving a run and time that's already there replaces
+# its record. Only shard 0 archives. Query it with series, or
+#
+#   python -m util.archive series <store> <variable> <lon> <lat>
+
+import calendar
+import datetime
+import math
+import os
+import sys
+from typing import NamedTuple, Optional
+
+import numpy as np
+import zarr
+from numcodecs import Blosc
+from osgeo import gdal
+
+from util import shards
+
+archive_dir = os.getenv("ARCHIVE_DIR")
+
+time_chunk = 32
+space_chunk = 64
+
+compressor = Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE)
+
+
+class Series(NamedTuple):
+    run: list[datetime.datetime]
+    valid: list[datetime.datetime]
+    # (record,) for a point, (record, lat, lon) for an area
+    values: np.ndarray
+
+
+def store_path(product: str) -> str:
+    return os.path.join(archive_dir, product + ".zarr")
+
+
+def _epoch(ts: datetime.datetime) -> int:
+    # naive times are UTC, as elsewhere
+    return calendar.timegm(ts.utctimetuple())
+
+
+def _from_epoch(seconds: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(int(seconds), datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _length(group: zarr.Group) -> int:
+    # stores from before length was recorded count the records with both a run and valid time
+    n = min(group["run"].shape[0], group["valid"].shape[0])
+    return min(group.attrs.get("length", n), n)
+
+
+def append(product: str, variable: str, run_ts: datetime.datetime, valid_ts: datetime.datetime, source_path: str):
+    if archive_dir is None or shards.index != 0:
+        return
+
+    ds = gdal.Warp("", source_path, format="MEM", dstSRS="EPSG:4326", resampleAlg="near",
+                   outputType=gdal.GDT_Float32, dstNodata=math.nan)
+    values = ds.GetRasterBand(1).ReadAsArray()
+    (west, lon_step, _, north, _, neg_lat_step) = ds.GetGeoTransform()
+    grid = {"west": west, "north": north, "lon_step": lon_step, "lat_step": -neg_lat_step}
+
+    group = zarr.open_group(store_path(product), mode="a").require_group(variable)
+    if "values" not in group:
+        group.attrs.update(grid)
+        group.create_dataset("values", shape=(0, *values.shape), chunks=(time_chunk, space_chunk, space_chunk),
+                             dtype="f4", fill_value=math.nan, compressor=compressor)
+        group.create_dataset("run", shape=(0,), chunks=(4096,), dtype="i8", compressor=compressor)
+        group.create_dataset("valid", shape=(0,), chunks=(4096,), dtype="i8", compressor=compressor)
+    if {k: group.attrs.get(k) for k in grid} != grid or group["values"].shape[1:] != values.shape:
+        raise RuntimeError(f"the grid of {product} {variable} changed, move {store_path(product)} aside to start a " +
+                           "new archive")
+
+    (run, valid) = (_epoch(run_ts), _epoch(valid_ts))
+    n = _length(group)
+    existing = np.flatnonzero((group["run"][:n] == run) & (group["valid"][:n] == valid))
+    if len(existing) > 0:
+        group["values"][int(existing[0])] = values
+    else:
+        if group["values"].shape[0] <= n:
+            group["values"].resize(n + 1, *values.shape)
+        for name in ["run", "valid"]:
+            if group[name].shape[0] <= n:
+                group[name].resize(n + 1)
+        group["values"][n] = values
+        group["run"][n] = run
+        group["valid"][n] = valid
+        group.attrs["length"] = n + 1
+    print(f"Archived {product} {variable} valid {valid_ts.isoformat()} from the {run_ts.isoformat()} run")
+
+
+def _records(
+        group: zarr.Group,
+        runs_from: Optional[datetime.datetime],
+        runs_to: Optional[datetime.datetime],
+) -> np.ndarray:
+    n = _length(group)
+    run = group["run"][:n]
+    keep = np.ones(run.shape, dtype=bool)
+    if runs_from is not None:
+        keep &= run >= _epoch(runs_from)
+    if runs_to is not None:
+        keep &= run <= _epoch(runs_to)
+    records = np.flatnonzero(keep)
+    # by run then valid time rather than the order they were archived in
+    valid = group["valid"][:n]
+    return records[np.lexsort((valid[records], run[records]))]
+
+
+def series(
+        path: str,
+        variable: str,
+        *,
+        point: Optional[tuple[float, float]] = None,
+        bounds: Optional[list[float]] = None,
+        runs_from: Optional[datetime.datetime] = None,
+        runs_to: Optional[datetime.datetime] = None,
+) -> Series:
+    # The values at a lon, lat point or in a left, bottom, right, top area for every record, optionally only of the
+    # runs between runs_from and runs_to inclusive
+    if (point is None) == (bounds is None):
+        raise RuntimeError("expected one of point or bounds")
+
+    group = zarr.open_group(path, mode="r")[variable]
+    (height, width) = group["values"].shape[1:]
+    (west, north, lon_step, lat_step) = (group.attrs["west"], group.attrs["north"], group.attrs["lon_step"],
+                                         group.attrs["lat_step"])
+    records = _records(group, runs_from, runs_to)
+    run = group["run"][:]
+    valid = group["valid"][:]
+
+    if point is not None:
+        col = math.floor((point[0] - west) / lon_step)
+        row = math.floor((north - point[1]) / lat_step)
+        if col < 0 or row < 0 or col >= width or row >= height:
+            raise RuntimeError(f"{point} is outside of the archived grid")
+        values = group["values"].get_orthogonal_selection((records, row, col))
+    else:
+        left = max(math.floor((bounds[0] - west) / lon_step), 0)
+        right = min(math.floor((bounds[2] - west) / lon_step) + 1, width)
+        top = max(math.floor((north - bounds[3]) / lat_step), 0)
+        bottom = min(math.floor((north - bounds[1]) / lat_step) + 1, height)
+        if left >= right or top >= bottom:
+            raise RuntimeError(f"{bounds} is outside of the archived grid")
+        values = group["values"].get_orthogonal_selection((records, slice(top, bottom), slice(left, right)))
+
+    return Series([_from_epoch(run[i]) for i in records], [_from_epoch(valid[i]) for i in records], values)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 6 or sys.argv[1] != "series":
+        print("usage: python -m util.archive series <store> <variable> <lon> <lat>")
+        sys.exit(1)
+    result = series(sys.argv[2], sys.argv[3], point=(float(sys.argv[4]), float(sys.argv[5])))
+    print("run,valid,value")
+    for (r, v, value) in zip(result.run, result.valid, result.values):
+        print(f"{r.isoformat()},{v.isoformat()},{'' if math.isnan(value) else f'{value:.3f}'}")
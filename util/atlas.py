@@ -0,0 +1,49 @@
+# Temporal tile atlases: every time step of one z/x/y in a single image, so an animation costs one request per map tile
+# instead of one per frame.
+#
+# Frames are stacked top to bottom in the order given, each tile_size pixels tall. A frame that has no tile at z/x/y
+# (for example because it was excluded as fully transparent, or the frame wasn't rendered) is left transparent.
+
+import os
+
+from PIL import Image
+
+from util.tiler import tile_size
+
+
+def write_atlas(frame_dirs: list[str], output_path: str) -> list[int]:
+    # frame_dirs are {z}/{x}/{y}.png pyramids. Returns the zoom levels written.
+    coords: set[tuple[int, int, int]] = set()
+    for frame_dir in frame_dirs:
+        coords.update(_tiles_in(frame_dir))
+
+    for (z, x, y) in sorted(coords):
+        sprite = Image.new("RGBA", (tile_size, tile_size * len(frame_dirs)))
+        for (i, frame_dir) in enumerate(frame_dirs):
+            frame_path = os.path.join(frame_dir, str(z), str(x), f"{y}.png")
+            if os.path.exists(frame_path):
+                with Image.open(frame_path) as frame:
+                    sprite.paste(frame.convert("RGBA"), (0, i * tile_size))
+
+        tile_dir = os.path.join(output_path, str(z), str(x))
+        os.makedirs(tile_dir, exist_ok=True)
+        sprite.save(os.path.join(tile_dir, f"{y}.png"), optimize=True)
+
+    print(f"Wrote {len(coords)} atlas tiles of {len(frame_dirs)} frames")
+    return sorted({z for (z, _x, _y) in coords})
+
+
+def _tiles_in(pyramid_dir: str) -> set[tuple[int, int, int]]:
+    out = set()
+    if not os.path.isdir(pyramid_dir):
+        return out
+    for z_entry in os.scandir(pyramid_dir):
+        if not (z_entry.is_dir() and z_entry.name.isdigit()):
+            continue
+        for x_entry in os.scandir(z_entry.path):
+            if not (x_entry.is_dir() and x_entry.name.isdigit()):
+                continue
+            for y_entry in os.scandir(x_entry.path):
+                if y_entry.name.endswith(".png"):
+                    out.add((int(z_entry.name), int(x_entry.name), int(y_entry.name.removesuffix(".png"))))
+    return out
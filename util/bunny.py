@@ -1,10 +1,13 @@
 import os
 import urllib
 from datetime import datetime, timedelta
+from typing import Optional
 
 import dateutil
 import requests
 
+from util.journal import Journal, file_digest
+
 bunnyStorageKey = os.getenv("BUNNY_WEATHER_STORAGE_KEY")
 bunnyKey = os.getenv("BUNNY_KEY")
 
@@ -14,11 +17,19 @@ if bunnyKey is None:
     raise Exception("BUNNY_KEY environment variable is not set")
 
 
-def weather_storage_upload(local_path: str, remote_path: str):
-    print(f"Uploading {remote_path}")
+def weather_storage_upload(local_path: str, remote_path: str, journal: Optional[Journal] = None):
     if remote_path.startswith("/"):
         remote_path = remote_path[1:]
 
+    digest = None
+    if journal is not None:
+        digest = file_digest(local_path)
+        if journal.is_done("upload", remote_path, digest):
+            print(f"Already uploaded {remote_path}")
+            return
+
+    print(f"Uploading {remote_path}")
+
     with open(local_path, "rb") as f:
         resp = requests.put(
             "https://storage.bunnycdn.com/pt-weather/" + remote_path,
@@ -28,6 +39,34 @@ def weather_storage_upload(local_path: str, remote_path: str):
         if resp.status_code < 200 or resp.status_code >= 300:
             raise RuntimeError(f"got status {resp.status_code} from {resp.url}")
 
+    if journal is not None:
+        journal.record("upload", remote_path, digest)
+
+
+def weather_storage_download(remote_path: str) -> Optional[bytes]:
+    # None if there's no such file
+    if remote_path.startswith("/"):
+        remote_path = remote_path[1:]
+
+    resp = requests.get("https://storage.bunnycdn.com/pt-weather/" + remote_path, headers={"AccessKey": bunnyStorageKey})
+    if resp.status_code == 404:
+        return None
+    if resp.status_code != 200:
+        raise RuntimeError(f"got status {resp.status_code} from {resp.url}")
+    return resp.content
+
+
+def weather_storage_delete(remote_path: str):
+    # A file, or with a trailing slash a directory and everything in it. Deleting what isn't there is fine.
+    if remote_path.startswith("/"):
+        remote_path = remote_path[1:]
+
+    resp = requests.delete("https://storage.bunnycdn.com/pt-weather/" + remote_path,
+                           headers={"AccessKey": bunnyStorageKey})
+    if resp.status_code not in [200, 404]:
+        raise RuntimeError(f"got status {resp.status_code} deleting {remote_path}")
+    print(f"Deleted {remote_path}")
+
 
 def purge(url: str):
     print(f"Purging {url}")
@@ -2,6 +2,8 @@ import colorsys
 import html
 from typing import Optional, NamedTuple
 
+import numpy as np
+
 
 class Entry(NamedTuple):
     v: Optional[float]
@@ -67,6 +69,42 @@ class Entry(NamedTuple):
             return _strip_trailing_zero_decimal(f'{self.v:,}')
 
 
+class CompiledColormap(NamedTuple):
+    # stop values in ascending order and the RGBA color of each
+    values: np.ndarray
+    colors: np.ndarray
+    # from the "nv" entry, or transparent if there isn't one
+    nodata_color: np.ndarray
+
+    def apply(self, data: np.ndarray, nodata: Optional[float]) -> np.ndarray:
+        # The nearest entry to each value like `gdaldem color-relief -nearest_color_entry`, as (..., 4) RGBA
+        return self.palette()[self._classes(data, nodata)]
+
+    def classify(self, data: np.ndarray, nodata: Optional[float]) -> np.ndarray:
+        # Like apply but the uint8 index of each color in palette
+        if len(self.colors) > 254:
+            raise RuntimeError(f"a colormap of {len(self.colors)} entries has too many to classify into a byte")
+        return self._classes(data, nodata).astype(np.uint8)
+
+    @property
+    def nodata_class(self) -> int:
+        return len(self.colors)
+
+    def palette(self) -> np.ndarray:
+        # RGBA of each class: the entries, then nodata_class, then a transparent class for pixels outside the source
+        return np.concatenate([self.colors, self.nodata_color[np.newaxis], np.zeros((1, 4), dtype=np.uint8)])
+
+    def _classes(self, data: np.ndarray, nodata: Optional[float]) -> np.ndarray:
+        midpoints = (self.values[:-1] + self.values[1:]) / 2
+        out = np.searchsorted(midpoints, data)
+
+        missing = np.isnan(data)
+        if nodata is not None:
+            missing |= data == nodata
+        out[missing] = self.nodata_class
+        return out
+
+
 class Colormap:
     doc_comment: Optional[str]
     units: str
@@ -140,6 +178,21 @@ class Colormap:
 
         return out
 
+    def compile(self) -> CompiledColormap:
+        stops = sorted([e for e in self.entries if e.v is not None], key=lambda e: e.v)
+        if len(stops) == 0:
+            raise RuntimeError("expected colormap to have at least one value")
+        nodata = next((e for e in self.entries if e.v is None), None)
+        return CompiledColormap(
+            np.array([e.v for e in stops], dtype=np.float64),
+            np.array([(*hsl_to_rgb(e.h, e.s, e.l), e.a) for e in stops], dtype=np.uint8),
+            np.zeros(4, dtype=np.uint8) if nodata is None else
+            np.array((*hsl_to_rgb(nodata.h, nodata.s, nodata.l), nodata.a), dtype=np.uint8),
+        )
+
+    def legend(self) -> list[dict]:
+        return [{"value": e.v, "color": e.css_color()} for e in self.entries if e.v is not None]
+
     def html_legend(self) -> str:
         entry_style = ('vertical-align: top; ' +
                        'height: 1.3em; ' +
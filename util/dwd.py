@@ -0,0 +1,132 @@
+# Fetches ICON-EU fields from the DWD open data server (https://opendata.dwd.de/weather/nwp/icon-eu/grib/).
+#
+# Files are downloaded concurrently over a pooled session and decompressed from bz2 as they stream in, in the same
+# worker threads (the bz2 module releases the GIL while decompressing). DWD_OPEN_DATA_URL points the fetcher at a
+# mirror with the same layout, either an http(s) URL or a local directory.
+
+import bz2
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
+from typing import Iterator, NamedTuple, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from util.journal import Journal, file_digest
+
+base_url = os.getenv("DWD_OPEN_DATA_URL", "https://opendata.dwd.de/weather/nwp").rstrip("/")
+
+workers = int(os.getenv("DWD_WORKERS", "8"))
+
+# Only these runs go out to 120 hours, the others stop at 30
+main_run_hours = [0, 6, 12, 18]
+
+chunk_size = 1 << 20
+
+
+class GribFile(NamedTuple):
+    run: datetime
+    step: int
+    path: str
+
+
+def file_name(field: str, run: datetime, step: int) -> str:
+    return f"icon-eu_europe_regular-lat-lon_single-level_{run.strftime('%Y%m%d%H')}_{step:03d}_{field.upper()}.grib2"
+
+
+def file_url(field: str, run: datetime, step: int) -> str:
+    return f"{base_url}/icon-eu/grib/{run.hour:02d}/{field.lower()}/{file_name(field, run, step)}.bz2"
+
+
+def _is_local() -> bool:
+    return not (base_url.startswith("http://") or base_url.startswith("https://"))
+
+
+def _session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _exists(session: requests.Session, url: str) -> bool:
+    if _is_local():
+        return os.path.exists(url)
+    resp = session.head(url, allow_redirects=True)
+    if resp.status_code == 404:
+        return False
+    if resp.status_code != 200:
+        raise RuntimeError(f"got status {resp.status_code} checking {url}")
+    return True
+
+
+def latest_run(field: str, now: datetime, max_step: int) -> datetime:
+    # The latest main run before now (naive UTC) whose last step has been published, so a run is never used half
+    # uploaded. Looks back a day, as the server keeps about that much.
+    with _session() as session:
+        for day in [now.date(), now.date() - timedelta(days=1)]:
+            for hour in reversed(main_run_hours):
+                run = datetime.combine(day, time(hour=hour))
+                if run <= now and _exists(session, file_url(field, run, max_step)):
+                    return run
+    raise RuntimeError(f"no complete {field} run available in the day before {now}")
+
+
+def _chunks(session: requests.Session, url: str) -> Iterator[bytes]:
+    if _is_local():
+        with open(url, "rb") as f:
+            yield from iter(lambda: f.read(chunk_size), b"")
+        return
+
+    with session.get(url, stream=True) as resp:
+        if resp.status_code != 200:
+            raise RuntimeError(f"got status {resp.status_code} downloading {url}")
+        yield from resp.iter_content(chunk_size)
+
+
+def _fetch_one(session: requests.Session, url: str, path: str):
+    decompressor = bz2.BZ2Decompressor()
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+        try:
+            for chunk in _chunks(session, url):
+                f.write(decompressor.decompress(chunk))
+            if not decompressor.eof:
+                raise RuntimeError(f"truncated download of {url}")
+        except BaseException:
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+def fetch(
+        field: str,
+        run: datetime,
+        steps: list[int],
+        out_dir: str,
+        journal: Optional[Journal] = None,
+) -> list[GribFile]:
+    os.makedirs(out_dir, exist_ok=True)
+    files = [GribFile(run, step, os.path.join(out_dir, file_name(field, run, step))) for step in steps]
+
+    def fetch_file(file: GribFile):
+        name = os.path.basename(file.path)
+        if os.path.exists(file.path) and journal is not None and journal.is_done("download", name, file_digest(file.path)):
+            print(f"Already downloaded {name}")
+            return
+
+        print(f"Downloading {name}")
+        _fetch_one(session, file_url(field, run, file.step), file.path)
+        if journal is not None:
+            journal.record("download", name, file_digest(file.path))
+
+    with _session() as session, ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() to raise the first error
+        list(pool.map(fetch_file, files))
+
+    print(f"Downloaded {len(files)} {field} files for the {run.strftime('%Y-%m-%d %H:%M')} UTC run")
+    return files
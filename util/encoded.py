@@ -0,0 +1,45 @@
+# Raster tiles that carry the physical value instead of a colour, in the style of Mapbox Terrain-RGB:
+#
+#   value = offset + scale * (R * 65536 + G * 256 + B)
+#
+# Pixels without data have alpha 0. Each product picks an offset and scale that covers its range at a useful
+# precision, and the tilejson carries them along with the colormap stops so clients can colorize on the GPU.
+
+from typing import NamedTuple
+
+import numpy as np
+from osgeo import gdal
+
+formula = "offset + scale * (R * 65536 + G * 256 + B)"
+
+
+class Encoding(NamedTuple):
+    offset: float
+    scale: float
+
+    def tilejson(self) -> dict:
+        return {"type": "rgb", "offset": self.offset, "scale": self.scale, "formula": formula}
+
+
+def write_encoded(source_path: str, output_path: str, encoding: Encoding):
+    src = gdal.Open(source_path)
+    band = src.GetRasterBand(1)
+    values = band.ReadAsArray().astype(np.float64)
+
+    valid = np.isfinite(values)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        valid &= values != nodata
+
+    q = np.zeros(values.shape, dtype=np.uint32)
+    q[valid] = np.clip(np.round((values[valid] - encoding.offset) / encoding.scale), 0, 2 ** 24 - 1)
+
+    out = gdal.GetDriverByName("GTiff").Create(output_path, src.RasterXSize, src.RasterYSize, 4, gdal.GDT_Byte,
+                                               options=["PHOTOMETRIC=RGB", "ALPHA=YES"])
+    out.SetGeoTransform(src.GetGeoTransform())
+    out.SetProjection(src.GetProjection())
+    out.GetRasterBand(1).WriteArray(((q >> 16) & 0xff).astype(np.uint8))
+    out.GetRasterBand(2).WriteArray(((q >> 8) & 0xff).astype(np.uint8))
+    out.GetRasterBand(3).WriteArray((q & 0xff).astype(np.uint8))
+    out.GetRasterBand(4).WriteArray(np.where(valid, 255, 0).astype(np.uint8))
+    out = None  # flush to disk
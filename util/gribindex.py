@@ -0,0 +1,204 @@
+# Index of the GRIB messages in a directory of downloads by validity time, step range and parameter, so selecting the
+# fields of a window reads just those messages instead of scanning every message of every file with Fieldset.select.
+#
+# Each file's headers are read once and the index is kept next to the files in index_name, keyed by each file's size
+# and mtime so a resumed run only indexes new or changed files.
+
+import datetime
+import json
+import mmap
+import os
+from typing import Iterable, NamedTuple, Optional
+
+import metview as mv
+
+import util
+
+index_name = ".gribindex.json"
+
+keys = ["shortName", "dataDate", "dataTime", "validityDate", "validityTime", "startStep", "endStep"]
+
+
+class Message(NamedTuple):
+    # file name within the indexed directory
+    file: str
+    offset: int
+    length: int
+    param: str
+    # naive UTC, like util.windows
+    data_ts: datetime.datetime
+    validity: datetime.datetime
+    start_step: int
+    end_step: int
+
+    def period(self) -> int:
+        # hours the field is a maximum or accumulation over, 0 for instantaneous values
+        return self.end_step - self.start_step
+
+    def to_json(self) -> list:
+        return [self.file, self.offset, self.length, self.param, self.data_ts.isoformat(), self.validity.isoformat(),
+                self.start_step, self.end_step]
+
+    @classmethod
+    def from_json(cls, v: list) -> 'Message':
+        return cls(v[0], v[1], v[2], v[3], datetime.datetime.fromisoformat(v[4]),
+                   datetime.datetime.fromisoformat(v[5]), v[6], v[7])
+
+
+class GribIndex:
+    def __init__(self, directory: str, messages: list[Message]):
+        self.directory = directory
+        self.messages = messages
+        # (param, period, validity) -> message, so fields of other parameters or step types, like an hour's maximum
+        # next to the instantaneous value, are never mixed into a selection
+        self._by_key: dict[tuple[str, int, datetime.datetime], Message] = {}
+        for m in messages:
+            self._by_key.setdefault((m.param, m.period(), m.validity), m)
+
+    @classmethod
+    def build(cls, directory: str) -> 'GribIndex':
+        index_path = os.path.join(directory, index_name)
+        cached = {}
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                cached = json.load(f)
+
+        files = {}
+        for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            prev = cached.get(entry.name)
+            if prev is not None and prev["size"] == stat.st_size and prev["mtime_ns"] == stat.st_mtime_ns:
+                files[entry.name] = prev
+            else:
+                files[entry.name] = {
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "messages": [m.to_json() for m in _index_file(directory, entry.name)],
+                }
+
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(files, f)
+        os.replace(index_path + ".tmp", index_path)
+
+        messages = [Message.from_json(m) for f in files.values() for m in f["messages"]]
+        print(f"Indexed {len(messages)} messages in {len(files)} files")
+        return cls(directory, messages)
+
+    def kind(self, param: Optional[str] = None, period: Optional[int] = None) -> tuple[str, int]:
+        # The parameter and period of the messages to select, where either left out must be the same for every message
+        selection = Selection(param, period)
+        kinds = {(p, n) for (p, n, _ts) in self._by_key if selection.matches(p, n)}
+        if len(kinds) != 1:
+            raise RuntimeError(f"expected messages of one parameter and period matching {param} and {period}, got " +
+                               f"{sorted(kinds)}")
+        return kinds.pop()
+
+    def select(self, param: Optional[str] = None, period: Optional[int] = None) -> list[Message]:
+        kind = self.kind(param, period)
+        return [m for (k, m) in self._by_key.items() if k[:2] == kind]
+
+    def at(
+            self,
+            validity: Iterable[datetime.datetime],
+            param: Optional[str] = None,
+            period: Optional[int] = None,
+    ) -> list[Message]:
+        (param, period) = self.kind(param, period)
+        out = []
+        for ts in validity:
+            m = self._by_key.get((param, period, ts))
+            if m is not None:
+                out.append(m)
+        return out
+
+    def data_datetime(self) -> datetime.datetime:
+        runs = {m.data_ts for m in self.messages}
+        if len(runs) != 1:
+            raise RuntimeError(f"expected messages from one model run, got {sorted(runs)}")
+        return runs.pop()
+
+    def fieldset(self, messages: list[Message], out_path: str) -> mv.Fieldset:
+        # Copies the messages into out_path by offset and opens them
+        if len(messages) == 0:
+            raise RuntimeError("no messages selected")
+
+        with open(out_path, "wb") as out:
+            for m in messages:
+                with open(os.path.join(self.directory, m.file), "rb") as f:
+                    f.seek(m.offset)
+                    out.write(f.read(m.length))
+        print(f"Selected {len(messages)} messages into {os.path.basename(out_path)}")
+        return mv.Fieldset(path=out_path)
+
+
+class Selection:
+    # The messages of one parameter and period, like GribIndex.kind, for fields streamed one at a time. Called with a
+    # field, as util.windows.StreamingReducer's validity_of, it gives the field's validity if it's selected and None
+    # if not, and raises once fields of a second parameter or period match what was left out.
+
+    def __init__(self, param: Optional[str] = None, period: Optional[int] = None):
+        self.param = param
+        self.period = period
+        self._kind: Optional[tuple[str, int]] = None
+
+    def matches(self, param: str, period: int) -> bool:
+        return (self.param is None or param == self.param) and (self.period is None or period == self.period)
+
+    def __call__(self, field: mv.Fieldset) -> Optional[datetime.datetime]:
+        row = field.ls(no_print=True, extra_keys=keys).iloc[0]
+        kind = (str(row["shortName"]), int(row["endStep"]) - int(row["startStep"]))
+        if not self.matches(*kind):
+            return None
+        if self._kind is None:
+            self._kind = kind
+        elif kind != self._kind:
+            raise RuntimeError(f"expected fields of one parameter and period matching {self.param} and " +
+                               f"{self.period}, got {self._kind} and {kind}")
+        return util.parse_numerical_timestamp(int(row["validityDate"]), int(row["validityTime"]))
+
+
+def _index_file(directory: str, name: str) -> list[Message]:
+    path = os.path.join(directory, name)
+    spans = message_spans(path)
+    rows = mv.Fieldset(path=path).ls(no_print=True, extra_keys=keys)
+    if len(rows) != len(spans):
+        raise RuntimeError(f"found {len(spans)} messages in {name} but metview read {len(rows)}")
+
+    out = []
+    for ((offset, length), (_i, row)) in zip(spans, rows.iterrows()):
+        out.append(Message(
+            name,
+            offset,
+            length,
+            str(row["shortName"]),
+            util.parse_numerical_timestamp(int(row["dataDate"]), int(row["dataTime"])),
+            util.parse_numerical_timestamp(int(row["validityDate"]), int(row["validityTime"])),
+            int(row["startStep"]),
+            int(row["endStep"]),
+        ))
+    return out
+
+
+def message_spans(path: str) -> list[tuple[int, int]]:
+    # (offset, length) of each message, from the length in its indicator section
+    spans = []
+    if os.path.getsize(path) == 0:
+        return spans
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos = 0
+        while True:
+            start = data.find(b"GRIB", pos)
+            if start < 0:
+                break
+            edition = data[start + 7]
+            if edition == 2:
+                length = int.from_bytes(data[start + 8:start + 16], "big")
+            elif edition == 1:
+                length = int.from_bytes(data[start + 4:start + 7], "big")
+            else:
+                raise RuntimeError(f"unsupported GRIB edition {edition} at {start} in {path}")
+            spans.append((start, length))
+            pos = start + length
+    return spans
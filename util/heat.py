@@ -0,0 +1,101 @@
+# Demand-driven tile selection from CDN access logs.
+#
+# Build a heat index of how often each product's z/x/y tiles were requested from exported logs (Bunny's pipe separated
+# format or anything else with the request URL on each line, optionally gzipped):
+#
+#   python -m util.heat build heat.npz logs/*.log.gz
+#
+# With HEAT_INDEX pointing at it, products render every tile up to HEAT_FULL_ZOOM but above it only tiles that were
+# requested at least HEAT_THRESHOLD times, counting requests for a tile's descendants as requests for it.
+#
+# The layers' tilejsons still advertise the full max zoom. Clients keep requesting the zooms people view, and those requests
+# are what the next heat index is built from. A tile that wasn't rendered is a 404, and as every tile up to
+# HEAT_FULL_ZOOM and every ancestor of a rendered tile is rendered, clients that keep showing the nearest loaded
+# ancestor of a tile that fails to load, as MapLibre does, overzoom that in its place. Leaflet needs such a fallback set
+# up itself.
+
+import gzip
+import os
+import re
+import sys
+from collections import Counter
+from typing import Iterator, Optional
+
+import numpy as np
+
+from util.tiler import TileFilter
+
+index_path = os.getenv("HEAT_INDEX")
+full_zoom = int(os.getenv("HEAT_FULL_ZOOM", "5"))
+threshold = int(os.getenv("HEAT_THRESHOLD", "1"))
+
+# /<product>/.../<z>/<x>/<y>.<png|pbf>, with or without the scheme and host
+tile_pattern = re.compile(
+    r"(?:https?://[^/|\s\"]+)?/(?P<product>[\w.-]+)/(?:[^|\s\"?]*/)?(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?:png|pbf)")
+
+
+def read_log(path: str) -> Iterator[tuple[str, int, int, int]]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", errors="replace") as f:
+        for line in f:
+            m = tile_pattern.search(line)
+            if m is not None:
+                yield m.group("product"), int(m.group("z")), int(m.group("x")), int(m.group("y"))
+
+
+def build(log_paths: list[str]) -> dict[str, Counter]:
+    index: dict[str, Counter] = {}
+    for path in log_paths:
+        requests = 0
+        for (product, z, x, y) in read_log(path):
+            index.setdefault(product, Counter())[(z, x, y)] += 1
+            requests += 1
+        print(f"Read {requests} tile requests from {path}")
+    return index
+
+
+def save(path: str, index: dict[str, Counter]):
+    # one (n, 4) z, x, y, count array per product
+    np.savez_compressed(path, **{
+        product: np.array([(z, x, y, c) for ((z, x, y), c) in counts.items()], dtype=np.uint32).reshape(-1, 4)
+        for (product, counts) in index.items()
+    })
+
+
+def load(path: str) -> dict[str, Counter]:
+    index = {}
+    with np.load(path) as f:
+        for product in f.files:
+            index[product] = Counter({(int(z), int(x), int(y)): int(c) for (z, x, y, c) in f[product]})
+    return index
+
+
+def tile_filter(product: str) -> Optional[TileFilter]:
+    # None, meaning every tile, when there's no heat index or it has nothing for the product
+    if index_path is None:
+        return None
+    counts = load(index_path).get(product)
+    if counts is None:
+        print(f"No heat for {product}, rendering every tile")
+        return None
+
+    # a request for a tile is demand for each of its ancestors too
+    demand: Counter = Counter()
+    for ((z, x, y), c) in counts.items():
+        while z > full_zoom:
+            demand[(z, x, y)] += c
+            (z, x, y) = (z - 1, x // 2, y // 2)
+    hot = {t for (t, c) in demand.items() if c >= threshold}
+    print(f"Rendering {len(hot)} tiles above zoom {full_zoom} for {product}")
+
+    def want(z: int, x: int, y: int) -> bool:
+        return z <= full_zoom or (z, x, y) in hot
+
+    return want
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] != "build":
+        print("usage: python -m util.heat build <index.npz> <log>...")
+        sys.exit(1)
+    save(sys.argv[2], build(sys.argv[3:]))
@@ -0,0 +1,92 @@
+import bisect
+import os
+
+from osgeo import gdal, ogr
+
+from util.colormap import Colormap
+
+layer_name = "isobands"
+
+# Vector coordinates at this zoom are already finer than any of our source grids, clients overzoom beyond it
+max_useful_zoom = 6
+
+# In tile coordinate units (4096 per tile), so the geometry is simplified more at lower zooms
+simplification = 8
+
+
+def generate_tiles(
+        source_path: str,
+        colormap_path: str,
+        output_path: str,
+        *,
+        scratch_dir: str,
+        min_zoom=1,
+        max_zoom=5,
+) -> dict:
+    cmap = Colormap.read(colormap_path)
+    stops = sorted([e for e in cmap.entries if e.v is not None], key=lambda e: e.v)
+    # Bands are split halfway between stops so they match the nearest_color_entry raster tiles
+    levels = [(a.v + b.v) / 2 for (a, b) in zip(stops, stops[1:])]
+
+    src = gdal.Open(source_path)
+    band = src.GetRasterBand(1)
+
+    bands_path = os.path.join(scratch_dir, "isobands.gpkg")
+    bands_ds = gdal.GetDriverByName("GPKG").Create(bands_path, 0, 0, 0, gdal.GDT_Unknown)
+    bands_layer = bands_ds.CreateLayer(layer_name, src.GetSpatialRef(), ogr.wkbMultiPolygon)
+    bands_layer.CreateField(ogr.FieldDefn("min", ogr.OFTReal))
+    bands_layer.CreateField(ogr.FieldDefn("max", ogr.OFTReal))
+
+    options = [
+        "ELEV_FIELD_MIN=0",
+        "ELEV_FIELD_MAX=1",
+        "POLYGONIZE=YES",
+        "FIXED_LEVELS=" + ",".join(str(l) for l in levels),
+    ]
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        options.append(f"NODATA={nodata}")
+    gdal.ContourGenerateEx(band, bands_layer, options=options)
+
+    # Replace the band bounds with the stop each band represents, dropping fully transparent bands
+    bands_layer.CreateField(ogr.FieldDefn("value", ogr.OFTReal))
+    bands_layer.CreateField(ogr.FieldDefn("color", ogr.OFTString))
+    bands_layer.StartTransaction()
+    for feature in list(bands_layer):
+        stop = stops[bisect.bisect_left(levels, feature.GetField("max"))]
+        if stop.a == 0:
+            bands_layer.DeleteFeature(feature.GetFID())
+            continue
+        feature.SetField("value", stop.v)
+        feature.SetField("color", stop.css_color())
+        bands_layer.SetFeature(feature)
+    bands_layer.CommitTransaction()
+    bands_ds = None  # flush to disk
+
+    max_zoom = max(min(max_zoom, max_useful_zoom), min_zoom)
+    ds = gdal.VectorTranslate(
+        output_path,
+        bands_path,
+        format="MVT",
+        selectFields=["value", "color"],
+        datasetCreationOptions=[
+            f"MINZOOM={min_zoom}",
+            f"MAXZOOM={max_zoom}",
+            f"SIMPLIFICATION={simplification}",
+            "TILE_EXTENSION=pbf",
+            "COMPRESS=NO",  # storage doesn't let us set Content-Encoding
+        ],
+    )
+    ds = None  # flush to disk
+
+    return {
+        "minzoom": min_zoom,
+        "maxzoom": max_zoom,
+        "vector_layers": [{
+            "id": layer_name,
+            "fields": {"value": "Number", "color": "String"},
+            "minzoom": min_zoom,
+            "maxzoom": max_zoom,
+        }],
+        "legend": cmap.legend(),
+    }
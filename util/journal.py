@@ -0,0 +1,95 @@
+# Checkpoints of completed work for a model run, so a job restarted after a crash only does what's left.
+#
+# When STATE_DIR is set each product keeps a journal and its downloads in STATE_DIR/<product>. The journal is a JSON
+# lines file whose first line names the run, followed by one line per completed unit with a content hash that is
+# checked before the unit is skipped. Starting a different run clears the product's state. Without STATE_DIR the
+# journal is only kept in memory.
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from typing import Optional
+
+state_dir = os.getenv("STATE_DIR")
+
+
+class Journal:
+    def __init__(self, directory: Optional[str], run: str):
+        self.directory = directory
+        self.run = run
+        self.resumed = False
+        self._entries: dict[tuple[str, str], str] = {}
+        self._path: Optional[str] = None
+        self._lock = threading.Lock()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._path = os.path.join(directory, "journal.jsonl")
+            self._load()
+
+    def _load(self):
+        if os.path.exists(self._path):
+            with open(self._path, "r") as f:
+                lines = [json.loads(l) for l in f if l.strip() != ""]
+            if len(lines) > 0 and lines[0].get("run") == self.run:
+                self.resumed = True
+                for entry in lines[1:]:
+                    self._entries[(entry["kind"], entry["key"])] = entry["hash"]
+                print(f"Resuming run {self.run} with {len(self._entries)} completed units")
+                return
+
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                shutil.rmtree(entry)
+            else:
+                os.remove(entry)
+        with open(self._path, "w") as f:
+            f.write(json.dumps({"run": self.run}) + "\n")
+
+    def work_dir(self, name: str, scratch_dir: str) -> str:
+        # A directory that survives restarts when the journal is persistent, or a scratch directory otherwise
+        d = os.path.join(self.directory or scratch_dir, name)
+        os.makedirs(d, exist_ok=True)
+        return d
+
+    def is_done(self, kind: str, key: str, digest: str) -> bool:
+        return self._entries.get((kind, key)) == digest
+
+    def record(self, kind: str, key: str, digest: str):
+        # may be called from download threads
+        with self._lock:
+            self._entries[(kind, key)] = digest
+            if self._path is not None:
+                with open(self._path, "a") as f:
+                    f.write(json.dumps({"kind": kind, "key": key, "hash": digest}) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+
+
+def open_journal(product: str, run: str) -> Journal:
+    if state_dir is None:
+        return Journal(None, run)
+    return Journal(os.path.join(state_dir, product), run)
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def tree_digest(path: str) -> str:
+    # Cheap fingerprint of a directory of many small files such as a tile pyramid: every path and size
+    h = hashlib.sha256()
+    if not os.path.isdir(path):
+        return ""
+    for (root, dirs, files) in os.walk(path):
+        dirs.sort()
+        for fname in sorted(files):
+            fpath = os.path.join(root, fname)
+            h.update(f"{os.path.relpath(fpath, path)}:{os.path.getsize(fpath)}\n".encode("utf8"))
+    return h.hexdigest()
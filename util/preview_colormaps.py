@@ -1,25 +1,161 @@
 #!/usr/bin/env python
+# Serves a preview of every colormap in colormaps/: the legend, and sample tiles of a stored example field rendered the
+# way render_layer renders them, along with how long that took and how large the tiles are.
+#
+# Store an example field (in the colormap's units) for a colormap with
+#   python util/preview_colormaps.py store-example temp_c.txt path/to/field.grib
+#
+# Parsed colormaps, example fields and rendered tiles are cached until their files' mtimes change.
+
+import hashlib
 import html
 import http.server
+import io
 import os
+import sys
+import threading
+import time
+from typing import Callable, NamedTuple, Optional, TypeVar
+
+import numpy as np
+from osgeo import gdal
 
+import tiler
 from colormap import Colormap
 
+gdal.UseExceptions()
+
 source_dir = "colormaps"
+example_dir = os.path.join(source_dir, "examples")
+
+preview_zoom = int(os.getenv("PREVIEW_ZOOM", "5"))
+sample_tile_count = 4
+
+T = TypeVar("T")
+
+_cache_lock = threading.Lock()
+_cache: dict[str, tuple[tuple, object]] = {}
+
+
+def _cached(key: str, version: tuple, load: Callable[[], T]) -> T:
+    with _cache_lock:
+        hit = _cache.get(key)
+    if hit is not None and hit[0] == version:
+        return hit[1]
+
+    value = load()
+    with _cache_lock:
+        _cache[key] = (version, value)
+    return value
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def colormap_names() -> list[str]:
+    return sorted(e.name for e in os.scandir(source_dir) if e.is_file())
+
+
+def example_path(name: str) -> str:
+    return os.path.join(example_dir, os.path.splitext(name)[0] + ".tif")
+
+
+def read_colormap(name: str) -> Colormap:
+    path = os.path.join(source_dir, name)
+    return _cached("colormap:" + name, (_mtime(path),), lambda: Colormap.read(path))
+
+
+class Example(NamedTuple):
+    values: np.ndarray
+    nodata: Optional[float]
+    # the sample tiles nearest the middle of the field at preview_zoom, as in tiler.ZoomIndex
+    tiles: np.ndarray
+    pixels: np.ndarray
+
+
+def read_example(name: str) -> Example:
+    path = example_path(name)
+
+    def load() -> Example:
+        ds = gdal.Open(path)
+        band = ds.GetRasterBand(1)
+        index = tiler.zoom_index(ds, preview_zoom)
+        distance = ((index.tiles - index.tiles.mean(axis=0)) ** 2).sum(axis=1)
+        nearest = np.argsort(distance, kind="stable")[:sample_tile_count]
+        return Example(band.ReadAsArray().ravel(), band.GetNoDataValue(), index.tiles[nearest], index.pixels[nearest])
+
+    return _cached("example:" + name, (_mtime(path),), load)
+
+
+class Samples(NamedTuple):
+    etag: str
+    # PNG by x, y at preview_zoom
+    tiles: dict[tuple[int, int], bytes]
+    seconds: float
+
+
+def render_samples(name: str) -> Optional[Samples]:
+    version = (_mtime(os.path.join(source_dir, name)), _mtime(example_path(name)))
+    if None in version:
+        return None
+
+    def load() -> Samples:
+        cmap = read_colormap(name)
+        example = read_example(name)
+
+        start = time.perf_counter()
+        render = tiler.colorized_render(cmap.compile().apply(example.values, example.nodata))
+        tiles = {}
+        for ((x, y), pixels) in zip(example.tiles, example.pixels):
+            buf = io.BytesIO()
+            render(pixels).save(buf, "png")
+            tiles[(int(x), int(y))] = buf.getvalue()
+        seconds = time.perf_counter() - start
+
+        return Samples(_etag(name, version), tiles, seconds)
+
+    return _cached("samples:" + name, version, load)
+
+
+def _etag(*parts) -> str:
+    return '"' + hashlib.sha256(repr(parts).encode("utf8")).hexdigest()[:16] + '"'
+
+
+def index_etag() -> str:
+    names = colormap_names()
+    return _etag(preview_zoom, [(n, _mtime(os.path.join(source_dir, n)), _mtime(example_path(n))) for n in names])
 
 
 def generate_preview() -> str:
     out = ""
-    for entry in sorted(os.scandir(source_dir), key=lambda e: e.name):
-        if entry.is_file():
-            fpath = os.path.join(source_dir, entry.name)
-            cmap = Colormap.read(fpath)
-
-            out += '<section>'
-            out += '<h2>' + html.escape(entry.name) + '</h2>'
-            out += '<p>' + html.escape(cmap.doc_comment) + '</p>'
-            out += '<div>' + cmap.html_legend() + '</div>'
-            out += '</section>'
+    for name in colormap_names():
+        cmap = read_colormap(name)
+
+        out += '<section>'
+        out += '<h2>' + html.escape(name) + '</h2>'
+        out += '<p>' + html.escape(cmap.doc_comment or "") + '</p>'
+        out += '<div>' + cmap.html_legend() + '</div>'
+
+        samples = render_samples(name)
+        if samples is None:
+            out += '<p class="stats">No example field at ' + html.escape(example_path(name)) + '</p>'
+        else:
+            total_bytes = sum(len(t) for t in samples.tiles.values())
+            out += ('<p class="stats">' +
+                    f'{len(samples.tiles)} tiles at zoom {preview_zoom} rendered in ' +
+                    f'{samples.seconds * 1000:.1f} ms, {total_bytes / 1024:.1f} KiB ' +
+                    f'({total_bytes / 1024 / max(len(samples.tiles), 1):.1f} KiB per tile)</p>')
+            out += '<div class="tiles">'
+            for (x, y) in sorted(samples.tiles):
+                url = f"/tiles/{name}/{preview_zoom}/{x}/{y}.png"
+                out += '<img src="' + html.escape(url) + '" alt="' + html.escape(f"{x}/{y}") + '">'
+            out += '</div>'
+
+        out += '</section>'
     return out
 
 
@@ -28,27 +164,34 @@ response_tmpl = """<!DOCTYPE html>
 <head>
     <title>Preview colormaps - weather-maps</title>
     <link rel="shortcut icon" type="image/x-icon" href="data:image/x-icon;,">
-    
+
     <style>
         body {
             font-family: "system-ui";
             color: rgb(51, 65, 85);
         }
-        
+
         .preview {
             font-size: 12px;
             width: 100%;
-            max-width: 400px;
+            max-width: 540px;
         }
-        
+
         .preview .source {
             overflow: auto;
             max-height: 4em;
         }
-        
+
         .legend-layer-content {
             opacity: 0.8;
         }
+
+        .tiles img {
+            width: 256px;
+            height: 256px;
+            margin: 2px;
+            border: 1px solid #d4d4d4;
+        }
     </style>
 </head>
 <body>
@@ -61,18 +204,65 @@ response_tmpl = """<!DOCTYPE html>
 # noinspection PyPep8Naming
 class RequestHandler(http.server.BaseHTTPRequestHandler):
     def do_GET(self):
-        preview = generate_preview()
+        if self.path == "/":
+            etag = index_etag()
+            if self._not_modified(etag):
+                return
+            body = response_tmpl.replace("__PREVIEW__", generate_preview()).encode("utf-8")
+            self._respond(body, "text/html; charset=utf-8", etag)
+        elif self.path.startswith("/tiles/"):
+            self._tile(self.path[len("/tiles/"):])
+        else:
+            self.send_error(404)
 
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
+    def _tile(self, path: str):
+        parts = path.removesuffix(".png").split("/")
+        if len(parts) != 4 or parts[0] not in colormap_names() or not all(p.isdigit() for p in parts[1:]):
+            self.send_error(404)
+            return
+        (name, z, x, y) = (parts[0], int(parts[1]), int(parts[2]), int(parts[3]))
+
+        samples = render_samples(name)
+        if samples is None or z != preview_zoom or (x, y) not in samples.tiles:
+            self.send_error(404)
+            return
+        if self._not_modified(samples.etag):
+            return
+        self._respond(samples.tiles[(x, y)], "image/png", samples.etag)
+
+    def _not_modified(self, etag: str) -> bool:
+        if self.headers.get("If-None-Match") != etag:
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
         self.end_headers()
+        return True
 
-        self.wfile.write(response_tmpl.replace("__PREVIEW__", preview).encode('utf-8'))
+    def _respond(self, body: bytes, content_type: str, etag: str):
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
         self.wfile.flush()
 
 
+def store_example(name: str, field_path: str):
+    os.makedirs(example_dir, exist_ok=True)
+    ds = gdal.Translate(example_path(name), field_path, format="GTiff", bandList=[1], outputType=gdal.GDT_Float32,
+                        creationOptions=["COMPRESS=DEFLATE", "PREDICTOR=3"])
+    ds = None  # flush to disk
+    print(f"Stored example for {name} at {example_path(name)}")
+
+
 if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == "store-example":
+        store_example(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
     addr = ('', 8080)
     print(f"Listening on {addr[0]}:{addr[1]}")
-    httpd = http.server.HTTPServer(addr, RequestHandler)
+    httpd = http.server.ThreadingHTTPServer(addr, RequestHandler)
     httpd.serve_forever()
@@ -0,0 +1,223 @@
+# Uploading a rendered run and making it live.
+#
+# A run's files go to <product>/<run>/ and its top level files (meta.json, legend.html) to <product>/, which are then
+# purged so clients switch to the new run.
+#
+# Publishing is progressive: tiles up to PROGRESSIVE_ZOOM and the other files are uploaded first, then the tilejsons
+# with their maxzoom capped at PROGRESSIVE_ZOOM and the top level files, so the run is live (overzoomed) as soon as
+# that's done. The higher zoom tiles follow, and last the capped tilejsons are replaced with the real ones and purged.
+#
+# When sharded (see util/shards.py) each shard uploads the tiles it rendered but holds back its tilejsons, and reports
+# them along with what it uploaded as a JSON file in SHARD_REPORT_DIR, or in storage if that isn't set, once after the
+# low zooms and once after the rest. Shard 0 is the coordinator: it waits for every shard's report of a stage before
+# uploading the tilejsons and top level files for it, so a run never goes live partly uploaded, and deletes the reports
+# once the run is published at all zooms. Run a product as local shard processes with
+#
+#   python -m util.publish run-local met_temp.py <shard count> <out dir>
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Optional
+
+import util
+from util import bunny, shards, tiler, warmup
+from util.journal import Journal
+
+cdn_url = "https://plantopo-weather.b-cdn.net/"
+
+progressive_zoom = int(os.getenv("PROGRESSIVE_ZOOM", "5"))
+
+report_dir = os.getenv("SHARD_REPORT_DIR")
+wait_seconds = int(os.getenv("SHARD_WAIT_SECONDS", "7200"))
+poll_seconds = 30
+
+
+def publish(
+        product: str,
+        run_dir: str,
+        run_name: str,
+        top_level_paths: list[str],
+        *,
+        journal: Optional[Journal] = None,
+):
+    top_level_paths = [os.path.abspath(p) for p in top_level_paths]
+    run_url = cdn_url + product + "/" + run_name
+
+    held: dict[str, str] = {}
+    low: list[str] = []
+    high: list[str] = []
+    for rel_path in warmup.files_in(run_dir):
+        local_path = os.path.abspath(os.path.join(run_dir, rel_path))
+        if local_path in top_level_paths:
+            continue
+        if rel_path.rsplit("/", 1)[-1] == "tilejson.json":
+            with open(local_path, "r") as f:
+                held[rel_path] = f.read()
+            continue
+        tile = tiler.parse_tile_path(rel_path)
+        if tile is not None and tile[0] > progressive_zoom:
+            high.append(rel_path)
+        else:
+            low.append(rel_path)
+
+    for rel_path in low:
+        bunny.weather_storage_upload(os.path.join(run_dir, rel_path), f"{product}/{run_name}/{rel_path}",
+                                     journal=journal)
+    if shards.is_sharded():
+        _write_report(product, run_name, "low", {"held": held, "uploaded": low})
+
+    if shards.index == 0:
+        if shards.is_sharded():
+            (held, low) = _gather_reports(product, run_name, "low")
+        _upload_tilejsons(product, run_name, {p: _cap_tilejson(c) for (p, c) in held.items()}, journal)
+        for path in top_level_paths:
+            name = os.path.basename(path)
+            bunny.weather_storage_upload(path, f"{product}/{name}", journal=journal)
+            bunny.purge(cdn_url + product + "/" + name)
+        print(f"Published {product}/{run_name} up to zoom {progressive_zoom}")
+
+    for rel_path in high:
+        bunny.weather_storage_upload(os.path.join(run_dir, rel_path), f"{product}/{run_name}/{rel_path}",
+                                     journal=journal)
+    if shards.is_sharded():
+        _write_report(product, run_name, "high", {"held": {}, "uploaded": high})
+        if shards.index != 0:
+            print(f"Shard {shards.index} of {shards.count} uploaded, shard 0 publishes the run")
+            return
+        (_, high) = _gather_reports(product, run_name, "high")
+
+    # only tilejsons that went up capped need replacing
+    full = {p: c for (p, c) in held.items() if _cap_tilejson(c) != c}
+    _upload_tilejsons(product, run_name, full, journal)
+    for rel_path in sorted(full):
+        bunny.purge(run_url + "/" + rel_path)
+    print(f"Published {product}/{run_name} at all zooms")
+    if shards.is_sharded():
+        _delete_reports(product, run_name)
+
+    if util.env_flag("CDN_WARMUP"):
+        warmup.warm_up(sorted(low + high + list(held)), run_url, [cdn_url + product + "/meta.json"])
+
+    bunny.weather_storage_delete_old(product + "/")
+
+
+def _cap_tilejson(content: str) -> str:
+    tilejson = json.loads(content)
+    if tilejson.get("maxzoom", 0) <= progressive_zoom:
+        return content
+    tilejson["maxzoom"] = progressive_zoom
+    tilejson["minzoom"] = min(tilejson.get("minzoom", 0), progressive_zoom)
+    for layer in tilejson.get("vector_layers", []):
+        if "maxzoom" in layer:
+            layer["maxzoom"] = min(layer["maxzoom"], progressive_zoom)
+        if "minzoom" in layer:
+            layer["minzoom"] = min(layer["minzoom"], progressive_zoom)
+    return json.dumps(tilejson, indent=2)
+
+
+def _upload_tilejsons(product: str, run_name: str, tilejsons: dict[str, str], journal: Optional[Journal]):
+    with tempfile.TemporaryDirectory() as held_dir:
+        for (i, (rel_path, content)) in enumerate(sorted(tilejsons.items())):
+            local_path = os.path.join(held_dir, f"{i}.json")
+            with open(local_path, "w") as f:
+                f.write(content)
+            bunny.weather_storage_upload(local_path, f"{product}/{run_name}/{rel_path}", journal=journal)
+
+
+def _report_path(product: str, run_name: str, stage: str, shard: int) -> str:
+    return f"{product}/_shards/{run_name}/{stage}/{shard}-of-{shards.count}.json"
+
+
+def _write_report(product: str, run_name: str, stage: str, report: dict):
+    path = _report_path(product, run_name, stage, shards.index)
+    if report_dir is None:
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+            f.write(json.dumps(report))
+            f.flush()
+            bunny.weather_storage_upload(f.name, path)
+        return
+
+    local_path = os.path.join(report_dir, path)
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    # written aside and renamed so the coordinator never reads a partial report
+    with tempfile.NamedTemporaryFile("w", suffix=".json", dir=os.path.dirname(local_path), delete=False) as f:
+        f.write(json.dumps(report))
+    os.replace(f.name, local_path)
+
+
+def _read_report(product: str, run_name: str, stage: str, shard: int) -> Optional[dict]:
+    path = _report_path(product, run_name, stage, shard)
+    if report_dir is None:
+        data = bunny.weather_storage_download(path)
+        return None if data is None else json.loads(data)
+
+    local_path = os.path.join(report_dir, path)
+    if not os.path.exists(local_path):
+        return None
+    with open(local_path, "r") as f:
+        return json.load(f)
+
+
+def _delete_reports(product: str, run_name: str):
+    # Only once the run is published, so a coordinator that's restarted before then still finds them
+    path = f"{product}/_shards/{run_name}/"
+    if report_dir is None:
+        bunny.weather_storage_delete(path)
+    else:
+        shutil.rmtree(os.path.join(report_dir, path), ignore_errors=True)
+
+
+def _gather_reports(product: str, run_name: str, stage: str) -> tuple[dict[str, str], list[str]]:
+    # A shard only reports a stage once everything it rendered for it is uploaded
+    deadline = time.monotonic() + wait_seconds
+    reports: dict[int, dict] = {}
+    while True:
+        for shard in range(shards.count):
+            if shard not in reports:
+                report = _read_report(product, run_name, stage, shard)
+                if report is not None:
+                    print(f"Shard {shard} reported {stage} zooms")
+                    reports[shard] = report
+
+        missing = [s for s in range(shards.count) if s not in reports]
+        if len(missing) == 0:
+            break
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"shards {missing} didn't report {stage} zooms within {wait_seconds}s")
+        time.sleep(poll_seconds)
+
+    held: dict[str, str] = {}
+    uploaded: set[str] = set()
+    for report in reports.values():
+        held.update(report["held"])
+        uploaded.update(report["uploaded"])
+    return held, sorted(uploaded)
+
+
+def run_local(script: str, count: int, out_root: str):
+    # Each shard gets its own out dir and state, and they report to a shared directory
+    local_report_dir = report_dir or os.path.join(out_root, "_reports")
+    util.ensure_empty_dir(local_report_dir)
+
+    procs = []
+    for i in range(count):
+        env = {**os.environ, "SHARD_INDEX": str(i), "SHARD_COUNT": str(count), "SHARD_REPORT_DIR": local_report_dir}
+        if "STATE_DIR" in os.environ:
+            env["STATE_DIR"] = os.path.join(os.environ["STATE_DIR"], f"shard-{i}")
+        procs.append(subprocess.Popen([sys.executable, script, os.path.join(out_root, f"shard-{i}")], env=env))
+
+    failed = [i for (i, p) in enumerate(procs) if p.wait() != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"shards {failed} failed")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5 or sys.argv[1] != "run-local":
+        print("usage: python -m util.publish run-local <product script> <shard count> <out dir>")
+        sys.exit(1)
+    run_local(sys.argv[2], int(sys.argv[3]), sys.argv[4])
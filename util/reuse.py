@@ -0,0 +1,118 @@
+# Reusing the layers of earlier runs, so a product can run for every model cycle while only rendering and uploading
+# what changed.
+#
+# Each run publishes layers.json next to meta.json, recording for every layer it advertises the URL it's at and a key
+# of its inputs: the field's values at the precision of the product's value encoding, and everything else that goes
+# into rendering it. The next run skips rendering a layer whose key is unchanged and advertises the earlier URL
+# instead. A layer the run has no complete window of data for, such as today's daytime after a late cycle, keeps the
+# earlier layer as is with keep.
+#
+# Layers are only reused while they're younger than max_age, so bunny.weather_storage_delete_old never removes a run
+# that's still advertised. With the atlas output mode nothing is reused, as an atlas needs every frame's tiles.
+
+import datetime
+import hashlib
+import json
+from typing import Optional
+
+import numpy as np
+import requests
+from osgeo import gdal
+
+import util
+from util import encoded, heat
+from util.journal import file_digest
+
+cdn_url = "https://plantopo-weather.b-cdn.net/"
+
+max_age = datetime.timedelta(days=5)
+
+
+class Layers:
+    def __init__(self, product: str, run_name: str, previous: dict[str, dict]):
+        self.product = product
+        self.run_url = cdn_url + product + "/" + run_name
+        self.enabled = "atlas" not in util.output_modes()
+        # layer name (its URL below the run) -> {"url", "key", "tilejson", "rendered"}
+        self.previous = previous
+        self.current: dict[str, dict] = {}
+
+    @classmethod
+    def load(cls, product: str, run_name: str) -> 'Layers':
+        resp = requests.get(cdn_url + product + "/layers.json")
+        if resp.status_code == 404:
+            return cls(product, run_name, {})
+        if resp.status_code != 200:
+            raise RuntimeError(f"got status {resp.status_code} fetching the layers of {product}")
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        previous = {}
+        for (name, layer) in resp.json().items():
+            if now - datetime.datetime.fromisoformat(layer["rendered"]) < max_age:
+                previous[name] = layer
+        print(f"{len(previous)} layers of {product} can be reused")
+        return cls(product, run_name, previous)
+
+    def _name(self, layer_url: str) -> str:
+        if not layer_url.startswith(self.run_url + "/"):
+            raise RuntimeError(f"layer {layer_url} is outside of {self.run_url}")
+        return layer_url[len(self.run_url) + 1:]
+
+    def reuse(self, layer_url: str, key: str) -> Optional[dict]:
+        # The tilejson of the earlier layer rendered from the same inputs, if there is one
+        name = self._name(layer_url)
+        layer = self.previous.get(name)
+        if not self.enabled or layer is None or layer["key"] != key:
+            return None
+        print(f"Reusing {layer['url']} for {name}")
+        self.current[name] = layer
+        return layer["tilejson"]
+
+    def keep(self, layer_url: str) -> bool:
+        # Carries the earlier layer over whatever its inputs were
+        name = self._name(layer_url)
+        layer = self.previous.get(name)
+        if not self.enabled or layer is None:
+            return False
+        print(f"Keeping {layer['url']} for {name}")
+        self.current[name] = layer
+        return True
+
+    def record(self, layer_url: str, key: str, tilejson: dict):
+        self.current[self._name(layer_url)] = {
+            "url": layer_url,
+            "key": key,
+            "tilejson": tilejson,
+            "rendered": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+
+    def tilejson_url(self, layer_url: str) -> Optional[str]:
+        # Where the layer's tilejson is published, or None if the run has no such layer
+        layer = self.current.get(self._name(layer_url))
+        return None if layer is None else layer["url"] + "/tilejson.json"
+
+    def save(self, path: str):
+        util.write_json(path, self.current)
+
+
+def layer_key(source_path: str, value_encoding: encoded.Encoding, config: dict) -> str:
+    # config is everything else the layer's outputs depend on, and must be JSON serializable
+    src = gdal.Open(source_path)
+    band = src.GetRasterBand(1)
+    values = band.ReadAsArray().astype(np.float64)
+    valid = np.isfinite(values)
+    if band.GetNoDataValue() is not None:
+        valid &= values != band.GetNoDataValue()
+    q = np.where(valid, np.round((values - value_encoding.offset) / value_encoding.scale), np.nan)
+
+    h = hashlib.sha256()
+    h.update(json.dumps({
+        **config,
+        "size": [src.RasterXSize, src.RasterYSize],
+        "geotransform": list(src.GetGeoTransform()),
+        "projection": src.GetProjection(),
+        "heat": file_digest(heat.index_path) if heat.index_path is not None else None,
+        "modes": sorted(util.output_modes()),
+    }, sort_keys=True).encode("utf8"))
+    h.update(q.tobytes())
+    return h.hexdigest()
@@ -0,0 +1,47 @@
+# Splitting a product's rendering across SHARD_COUNT shards, such as the pods of a Kubernetes Indexed Job (which sets
+# JOB_COMPLETION_INDEX) or local processes started by `python -m util.publish run-local`.
+#
+# Every shard downloads and reduces the whole run and then renders only its share. Raster tiles are assigned in square
+# blocks of tiles, the same for every layer, so all the frames of an atlas tile end up on the same shard. The other
+# output modes are assigned by layer. See util/publish.py for how the shards' uploads are brought together.
+
+import os
+import zlib
+from typing import Optional
+
+from util.tiler import TileFilter
+
+index = int(os.getenv("SHARD_INDEX", os.getenv("JOB_COMPLETION_INDEX", "0")))
+count = int(os.getenv("SHARD_COUNT", "1"))
+
+# blocks are 2^block_shift tiles on a side
+block_shift = 2
+
+if not 0 <= index < count:
+    raise RuntimeError(f"shard index {index} is outside of the {count} shards")
+
+
+def is_sharded() -> bool:
+    return count > 1
+
+
+def _shard_of(key: str) -> int:
+    # crc32 rather than hash() as it must agree between processes
+    return zlib.crc32(key.encode("utf8")) % count
+
+
+def owns_layer(layer_key: str) -> bool:
+    return _shard_of(layer_key) == index
+
+
+def tile_filter(base: Optional[TileFilter] = None) -> Optional[TileFilter]:
+    # base further limits the tiles, for example to those in demand
+    if not is_sharded():
+        return base
+
+    def want(z: int, x: int, y: int) -> bool:
+        if _shard_of(f"{z}/{x >> block_shift}/{y >> block_shift}") != index:
+            return False
+        return base is None or base(z, x, y)
+
+    return want
@@ -0,0 +1,313 @@
+# XYZ tiling that replaces gdal2tiles.
+#
+# Every layer of a run shares the same source grid, so the warp to web mercator is computed once per grid and zoom as
+# an index from each output tile pixel to the source pixel it samples (nearest neighbour, as our data is categorical).
+# The index is cached in memory and on disk keyed by the grid definition, so tiling a layer is then a NumPy gather.
+#
+# The disk cache is in REPROJECTION_CACHE_DIR, by default weather-maps-reprojection in STATE_DIR, or in the
+# temporary directory without STATE_DIR. It only pays off across runs on a volume that outlives them. The CronJobs in
+# infra/ mount STATE_DIR from the pod's emptyDir, so there it only survives a retried container, and between runs only
+# the long-lived worker (worker.py) gains from the cache, in memory as well as on disk.
+
+import hashlib
+import math
+import os
+import tempfile
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+from osgeo import gdal, osr
+
+tile_size = 512
+
+cache_dir = os.getenv("REPROJECTION_CACHE_DIR") or os.path.join(
+    os.getenv("STATE_DIR") or tempfile.gettempdir(), "weather-maps-reprojection")
+
+# half the width of the web mercator world in meters
+mercator_extent = 20037508.342789244
+mercator_max_lat = 85.0511287798066
+
+
+class ZoomIndex(NamedTuple):
+    zoom: int
+    # (n, 2) x, y of the tiles that overlap the source
+    tiles: np.ndarray
+    # (n, tile_size * tile_size) index into the flattened source for each tile pixel. Pixels outside the source have
+    # the index source width * source height, one past the end.
+    pixels: np.ndarray
+
+
+# z, x, y -> whether to write the tile
+TileFilter = Callable[[int, int, int], bool]
+
+_memory_cache: dict[str, ZoomIndex] = {}
+
+
+def grid_key(ds: gdal.Dataset) -> str:
+    h = hashlib.sha256()
+    h.update(ds.GetProjection().encode("utf8"))
+    h.update(repr((ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize, tile_size)).encode("utf8"))
+    return h.hexdigest()[:32]
+
+
+def zoom_index(ds: gdal.Dataset, zoom: int) -> ZoomIndex:
+    key = f"{grid_key(ds)}_z{zoom}"
+    if key in _memory_cache:
+        return _memory_cache[key]
+
+    path = os.path.join(cache_dir, key + ".npz")
+    if os.path.exists(path):
+        with np.load(path) as f:
+            index = ZoomIndex(zoom, f["tiles"], f["pixels"])
+    else:
+        print(f"Computing reprojection index for zoom {zoom}")
+        index = compute_zoom_index(ds, zoom)
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".npz", delete=False) as f:
+            np.savez(f, tiles=index.tiles, pixels=index.pixels)
+        os.replace(f.name, path)
+
+    _memory_cache[key] = index
+    return index
+
+
+def compute_zoom_index(ds: gdal.Dataset, zoom: int) -> ZoomIndex:
+    width = ds.RasterXSize
+    height = ds.RasterYSize
+    to_pixel = _lon_lat_to_pixel(ds)
+
+    (west, south, east, north) = _lon_lat_bounds(ds)
+    (min_x, min_y) = _tile_of(west, north, zoom)
+    (max_x, max_y) = _tile_of(east, south, zoom)
+
+    resolution = 2 * mercator_extent / (tile_size * 2 ** zoom)
+    offsets = np.arange(tile_size) + 0.5
+
+    tiles = []
+    pixels = []
+    for y in range(min_y, max_y + 1):
+        merc_y = mercator_extent - (y * tile_size + offsets) * resolution
+        lat = np.degrees(np.arctan(np.sinh(merc_y / mercator_extent * math.pi)))
+        for x in range(min_x, max_x + 1):
+            merc_x = -mercator_extent + (x * tile_size + offsets) * resolution
+            lon = merc_x / mercator_extent * 180
+
+            (lon_grid, lat_grid) = np.meshgrid(lon, lat)
+            (col, row) = to_pixel(lon_grid.ravel(), lat_grid.ravel())
+            inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+            if not inside.any():
+                continue
+
+            tiles.append((x, y))
+            pixels.append(np.where(inside, row * width + col, width * height).astype(np.uint32))
+
+    if len(tiles) == 0:
+        return ZoomIndex(zoom, np.empty((0, 2), dtype=np.int64), np.empty((0, tile_size * tile_size), np.uint32))
+    return ZoomIndex(zoom, np.array(tiles), np.stack(pixels))
+
+
+def generate_tiles(
+        input_path: str,
+        output_path: str,
+        *,
+        min_zoom=1,
+        max_zoom=5,
+        exclude_transparent=False,
+        tile_filter: Optional[TileFilter] = None,
+):
+    # Writes output_path/{z}/{x}/{y}.png from a 1 (grey), 3 (RGB) or 4 (RGBA) band byte raster
+    ds = gdal.Open(input_path)
+    mode = {1: "L", 3: "RGB", 4: "RGBA"}[ds.RasterCount]
+    # the extra trailing zero is what pixels outside the source sample, which is transparent for RGBA
+    bands = [np.append(ds.GetRasterBand(i + 1).ReadAsArray().ravel(), np.uint8(0)) for i in range(ds.RasterCount)]
+
+    def render(pixels: np.ndarray) -> Optional[Image.Image]:
+        data = np.stack([b[pixels] for b in bands], axis=-1).reshape(tile_size, tile_size, len(bands))
+        if exclude_transparent and mode == "RGBA" and not data[:, :, 3].any():
+            return None
+        return Image.fromarray(data.squeeze(axis=-1) if mode == "L" else data, mode)
+
+    write_tiles(ds, output_path, render, min_zoom=min_zoom, max_zoom=max_zoom, tile_filter=tile_filter)
+
+
+def generate_colorized_tiles(
+        input_path: str,
+        colorize: Callable[[np.ndarray, Optional[float]], np.ndarray],
+        output_path: str,
+        *,
+        min_zoom=1,
+        max_zoom=5,
+        exclude_transparent=False,
+        tile_filter: Optional[TileFilter] = None,
+):
+    # Like generate_tiles on a color relief of the source, but colorizes the single band source in memory.
+    # colorize maps the values and the nodata value to RGBA, see CompiledColormap.apply
+    ds = gdal.Open(input_path)
+    band = ds.GetRasterBand(1)
+    rgba = colorize(band.ReadAsArray().ravel(), band.GetNoDataValue())
+    render = colorized_render(rgba, exclude_transparent=exclude_transparent)
+    write_tiles(ds, output_path, render, min_zoom=min_zoom, max_zoom=max_zoom, tile_filter=tile_filter)
+
+
+def colorized_render(rgba: np.ndarray, *, exclude_transparent=False) -> Callable[[np.ndarray], Optional[Image.Image]]:
+    # rgba is (source width * source height, 4), the extra row is what pixels outside the source sample
+    rgba = np.append(rgba, np.zeros((1, 4), dtype=np.uint8), axis=0)
+
+    def render(pixels: np.ndarray) -> Optional[Image.Image]:
+        data = rgba[pixels].reshape(tile_size, tile_size, 4)
+        if exclude_transparent and not data[:, :, 3].any():
+            return None
+        return Image.fromarray(data, "RGBA")
+
+    return render
+
+
+def generate_classified_tiles(
+        input_path: str,
+        classify: Callable[[np.ndarray, Optional[float]], np.ndarray],
+        palette: np.ndarray,
+        output_path: str,
+        *,
+        min_zoom=1,
+        max_zoom=5,
+        exclude_transparent=False,
+        tile_filter: Optional[TileFilter] = None,
+):
+    # Like generate_colorized_tiles, but the source is classified into a byte per pixel and tiles are written as
+    # palette PNGs, which is a quarter of the memory to gather from and much less to encode. classify maps the values
+    # and the nodata value to uint8 indexes into palette, (classes, 4) RGBA whose last entry is for pixels outside of
+    # the source, see CompiledColormap.classify and CompiledColormap.palette
+    ds = gdal.Open(input_path)
+    band = ds.GetRasterBand(1)
+    classes = np.append(classify(band.ReadAsArray().ravel(), band.GetNoDataValue()), np.uint8(len(palette) - 1))
+
+    transparent = palette[:, 3] == 0
+    # PIL takes the palette as RGB and the alpha of each entry as the tRNS chunk
+    rgb = palette[:, :3].ravel().tobytes()
+    alpha = palette[:, 3].tobytes()
+
+    def render(pixels: np.ndarray) -> Optional[Image.Image]:
+        data = classes[pixels].reshape(tile_size, tile_size)
+        if exclude_transparent and transparent[data].all():
+            return None
+        img = Image.fromarray(data, "P")
+        img.putpalette(rgb, "RGB")
+        img.info["transparency"] = alpha
+        return img
+
+    write_tiles(ds, output_path, render, min_zoom=min_zoom, max_zoom=max_zoom, tile_filter=tile_filter)
+
+
+def write_tiles(
+        ds: gdal.Dataset,
+        output_path: str,
+        render: Callable[[np.ndarray], Optional[Image.Image]],
+        *,
+        min_zoom: int,
+        max_zoom: int,
+        tile_filter: Optional[TileFilter] = None,
+):
+    # render is called with the source pixel index of each tile and returns None to skip the tile. Tiles tile_filter
+    # rejects aren't rendered at all.
+    for zoom in range(min_zoom, max_zoom + 1):
+        index = zoom_index(ds, zoom)
+        for ((x, y), pixels) in zip(index.tiles, index.pixels):
+            if tile_filter is not None and not tile_filter(zoom, int(x), int(y)):
+                continue
+            img = render(pixels)
+            if img is None:
+                continue
+            tile_dir = os.path.join(output_path, str(zoom), str(x))
+            os.makedirs(tile_dir, exist_ok=True)
+            img.save(os.path.join(tile_dir, f"{y}.png"))
+
+
+def tile_range(bounds: list[float], zoom: int) -> tuple[int, int, int, int]:
+    # min x, min y, max x, max y (inclusive) of the tiles covering left,bottom,right,top
+    (left, bottom, right, top) = bounds
+    (min_x, min_y) = _tile_of(left, min(top, mercator_max_lat), zoom)
+    (max_x, max_y) = _tile_of(right, max(bottom, -mercator_max_lat), zoom)
+    return min_x, min_y, max_x, max_y
+
+
+def parse_tile_path(rel_path: str) -> Optional[tuple[int, int, int]]:
+    # z, x, y of a .../<z>/<x>/<y>.<ext> path, or None if it isn't a tile
+    parts = rel_path.split("/")
+    if len(parts) < 3:
+        return None
+    (z, x, y) = (parts[-3], parts[-2], os.path.splitext(parts[-1])[0])
+    if not (z.isdigit() and x.isdigit() and y.isdigit()):
+        return None
+    return int(z), int(x), int(y)
+
+
+def _lon_lat_to_pixel(ds: gdal.Dataset) -> Callable[[np.ndarray, np.ndarray], tuple[np.ndarray, np.ndarray]]:
+    (origin_x, pixel_width, _, origin_y, _, pixel_height) = ds.GetGeoTransform()
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+
+    if srs.IsGeographic():
+        # some grids use longitudes from 0 to 360
+        wraps = origin_x + ds.RasterXSize * pixel_width > 180
+
+        def to_xy(lon, lat):
+            if wraps:
+                lon = np.where(lon < origin_x, lon + 360, lon)
+            return lon, lat
+    else:
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromEPSG(4326)
+        wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(wgs84, srs)
+
+        def to_xy(lon, lat):
+            points = np.array(transform.TransformPoints(np.column_stack([lon, lat]).tolist()))
+            return points[:, 0], points[:, 1]
+
+    def to_pixel(lon, lat):
+        (x, y) = to_xy(lon, lat)
+        col = np.floor((x - origin_x) / pixel_width).astype(np.int64)
+        row = np.floor((y - origin_y) / pixel_height).astype(np.int64)
+        return col, row
+
+    return to_pixel
+
+
+def _lon_lat_bounds(ds: gdal.Dataset) -> tuple[float, float, float, float]:
+    (origin_x, pixel_width, _, origin_y, _, pixel_height) = ds.GetGeoTransform()
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+
+    # the outline of the source in its own coordinates
+    steps = np.linspace(0, 1, 101)
+    edge_cols = np.concatenate([steps, steps, np.zeros_like(steps), np.ones_like(steps)]) * ds.RasterXSize
+    edge_rows = np.concatenate([np.zeros_like(steps), np.ones_like(steps), steps, steps]) * ds.RasterYSize
+    x = origin_x + edge_cols * pixel_width
+    y = origin_y + edge_rows * pixel_height
+
+    if srs.IsGeographic():
+        (lon, lat) = (x, y)
+        if lon.min() >= 180:
+            lon = lon - 360
+    else:
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromEPSG(4326)
+        wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(srs, wgs84)
+        points = np.array(transform.TransformPoints(np.column_stack([x, y]).tolist()))
+        (lon, lat) = (points[:, 0], points[:, 1])
+
+    return (
+        max(float(lon.min()), -180),
+        max(float(lat.min()), -mercator_max_lat),
+        min(float(lon.max()), 180),
+        min(float(lat.max()), mercator_max_lat),
+    )
+
+
+def _tile_of(lon: float, lat: float, zoom: int) -> tuple[int, int]:
+    n = 2 ** zoom
+    x = math.floor((lon + 180) / 360 * n)
+    y = math.floor((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
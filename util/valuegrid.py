@@ -0,0 +1,143 @@
+# Compact per-layer value grids for point and small-area queries.
+#
+# The field is reprojected to a regular lon/lat grid and quantized to uint16 as `value = offset + scale * q`, with
+# q = 65535 meaning no data. The grid is split into square blocks so a client can fetch the block it needs with an HTTP
+# range request.
+#
+# Layout, little-endian:
+#
+#   header (header_size bytes, see header_format):
+#     magic "WMVG", version, block size, width, height,
+#     west, north, lon step, lat step (positive, rows go south),
+#     offset, scale
+#   blocks, row-major by block then by pixel within each block. Each block is block size * block size uint16 values,
+#   padded with no data past the right and bottom edges of the grid.
+#
+# The byte range of the block containing pixel (col, row) is
+#
+#   start = header_size + ((row // block size) * ceil(width / block size) + col // block size) * block size^2 * 2
+#   end = start + block size^2 * 2 (exclusive)
+
+import math
+import struct
+from typing import NamedTuple, Optional
+
+import numpy as np
+from osgeo import gdal
+
+magic = b"WMVG"
+version = 1
+header_format = "<4sHHIIdddddd"
+header_size = struct.calcsize(header_format)
+nodata = 65535
+default_block_size = 64
+
+
+class Header(NamedTuple):
+    block_size: int
+    width: int
+    height: int
+    west: float
+    north: float
+    lon_step: float
+    lat_step: float
+    offset: float
+    scale: float
+
+    @property
+    def blocks_x(self) -> int:
+        return math.ceil(self.width / self.block_size)
+
+    @property
+    def blocks_y(self) -> int:
+        return math.ceil(self.height / self.block_size)
+
+    @property
+    def block_bytes(self) -> int:
+        return self.block_size * self.block_size * 2
+
+    def pixel(self, lon: float, lat: float) -> Optional[tuple[int, int]]:
+        col = math.floor((lon - self.west) / self.lon_step)
+        row = math.floor((self.north - lat) / self.lat_step)
+        if col < 0 or row < 0 or col >= self.width or row >= self.height:
+            return None
+        return col, row
+
+    def block_byte_range(self, col: int, row: int) -> tuple[int, int]:
+        block = (row // self.block_size) * self.blocks_x + col // self.block_size
+        start = header_size + block * self.block_bytes
+        return start, start + self.block_bytes
+
+
+def write(source_path: str, output_path: str, *, block_size=default_block_size) -> Header:
+    ds = gdal.Warp("", source_path, format="MEM", dstSRS="EPSG:4326", resampleAlg="near",
+                   outputType=gdal.GDT_Float64, dstNodata=math.nan)
+    values = ds.GetRasterBand(1).ReadAsArray()
+    (west, lon_step, _, north, _, neg_lat_step) = ds.GetGeoTransform()
+
+    valid = np.isfinite(values)
+    if valid.any():
+        lo = float(values[valid].min())
+        hi = float(values[valid].max())
+    else:
+        lo, hi = 0.0, 0.0
+    scale = (hi - lo) / (nodata - 1) if hi > lo else 1.0
+
+    (height, width) = values.shape
+    header = Header(block_size, width, height, west, north, lon_step, -neg_lat_step, lo, scale)
+
+    quantized = np.full((header.blocks_y * block_size, header.blocks_x * block_size), nodata, dtype="<u2")
+    quantized[:height, :width][valid] = np.round((values[valid] - lo) / scale).astype("<u2")
+    blocks = quantized.reshape(header.blocks_y, block_size, header.blocks_x, block_size).swapaxes(1, 2)
+
+    with open(output_path, "wb") as f:
+        f.write(struct.pack(header_format, magic, version, *header))
+        f.write(np.ascontiguousarray(blocks).tobytes())
+    return header
+
+
+class ValueGrid:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            raw = struct.unpack(header_format, f.read(header_size))
+        if raw[0] != magic or raw[1] != version:
+            raise RuntimeError(f"{path} is not a version {version} value grid")
+        self.header = Header(*raw[2:])
+        h = self.header
+        self.blocks = np.memmap(path, dtype="<u2", mode="r", offset=header_size,
+                                shape=(h.blocks_y, h.blocks_x, h.block_size, h.block_size))
+
+    def value_at(self, lon: float, lat: float) -> Optional[float]:
+        pixel = self.header.pixel(lon, lat)
+        if pixel is None:
+            return None
+        (col, row) = pixel
+        bs = self.header.block_size
+        q = int(self.blocks[row // bs, col // bs, row % bs, col % bs])
+        if q == nodata:
+            return None
+        return self.header.offset + self.header.scale * q
+
+    def values_in(self, bounds: list[float]) -> np.ndarray:
+        # bounds is left, bottom, right, top. Returns the covered pixels as float64 with NaN for no data.
+        h = self.header
+        left = max(math.floor((bounds[0] - h.west) / h.lon_step), 0)
+        right = min(math.floor((bounds[2] - h.west) / h.lon_step) + 1, h.width)
+        top = max(math.floor((h.north - bounds[3]) / h.lat_step), 0)
+        bottom = min(math.floor((h.north - bounds[1]) / h.lat_step) + 1, h.height)
+        if left >= right or top >= bottom:
+            return np.empty((0, 0))
+
+        bs = h.block_size
+        out = np.empty((bottom - top, right - left))
+        for by in range(top // bs, (bottom - 1) // bs + 1):
+            for bx in range(left // bs, (right - 1) // bs + 1):
+                y0, y1 = max(top, by * bs), min(bottom, (by + 1) * bs)
+                x0, x1 = max(left, bx * bs), min(right, (bx + 1) * bs)
+                q = self.blocks[by, bx, y0 - by * bs:y1 - by * bs, x0 - bx * bs:x1 - bx * bs]
+                out[y0 - top:y1 - top, x0 - left:x1 - left] = np.where(q == nodata, np.nan, h.offset + h.scale * q)
+        return out
+
+
+def read_point(path: str, lon: float, lat: float) -> Optional[float]:
+    return ValueGrid(path).value_at(lon, lat)
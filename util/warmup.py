@@ -0,0 +1,98 @@
+# Requests freshly published tiles through the pull zone so they're cached at the edge before users ask for them.
+#
+# Every tile up to WARMUP_FULL_ZOOM is requested, and above it only those intersecting WARMUP_AREAS
+# ("left,bottom,right,top;..."). Tilejsons are always requested. Enable with CDN_WARMUP=1.
+
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import util
+from util import tiler
+
+full_zoom = int(os.getenv("WARMUP_FULL_ZOOM", "5"))
+areas = util.parse_areas(os.getenv("WARMUP_AREAS"))
+concurrency = int(os.getenv("WARMUP_CONCURRENCY", "16"))
+
+
+class Result(NamedTuple):
+    url: str
+    status: Optional[int]
+    # Bunny's CDN-Cache header, HIT or MISS
+    cache: str
+    seconds: float
+
+
+def files_in(local_dir: str) -> list[str]:
+    # paths relative to local_dir, with / separators like the URLs they're published at
+    out = []
+    for (root, _dirs, files) in os.walk(local_dir):
+        for fname in files:
+            out.append(os.path.relpath(os.path.join(root, fname), local_dir).replace(os.sep, "/"))
+    return sorted(out)
+
+
+def select(paths: list[str]) -> list[str]:
+    return [p for p in paths if p.rsplit("/", 1)[-1] == "tilejson.json" or _wanted_tile(p)]
+
+
+def _wanted_tile(rel_path: str) -> bool:
+    tile = tiler.parse_tile_path(rel_path)
+    if tile is None:
+        return False
+    (z, x, y) = tile
+
+    if z <= full_zoom:
+        return True
+    for area in areas:
+        (min_x, min_y, max_x, max_y) = tiler.tile_range(area, z)
+        if min_x <= x <= max_x and min_y <= y <= max_y:
+            return True
+    return False
+
+
+def warm_up(paths: list[str], base_url: str, extra_urls: Optional[list[str]] = None) -> list[Result]:
+    # paths are relative to base_url, see files_in. extra_urls are requested too, such as the product's meta.json.
+    urls = [base_url.rstrip("/") + "/" + path for path in select(paths)] + (extra_urls or [])
+    print(f"Warming up {len(urls)} files under {base_url}")
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=concurrency))
+
+    def fetch(url: str) -> Result:
+        start = time.perf_counter()
+        try:
+            resp = session.get(url)
+            # read the body so the edge finishes filling its cache
+            _ = resp.content
+            return Result(url, resp.status_code, resp.headers.get("CDN-Cache", "UNKNOWN"), time.perf_counter() - start)
+        except requests.RequestException as e:
+            print(f"Failed to warm up {url}: {e}")
+            return Result(url, None, "ERROR", time.perf_counter() - start)
+
+    with session, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fetch, urls))
+
+    report(results)
+    return results
+
+
+def report(results: list[Result]):
+    by_cache: dict[str, list[float]] = {}
+    for r in results:
+        by_cache.setdefault(r.cache, []).append(r.seconds)
+
+    for (cache, seconds) in sorted(by_cache.items()):
+        seconds.sort()
+        p95 = seconds[min(int(len(seconds) * 0.95), len(seconds) - 1)]
+        print(f"Warm-up {cache}: {len(seconds)} requests, " +
+              f"median {statistics.median(seconds) * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms")
+
+    failed = [r for r in results if r.status is None or r.status >= 400]
+    if len(failed) > 0:
+        print(f"Warm-up failed for {len(failed)} requests, e.g. {failed[0].url} ({failed[0].status})")
@@ -0,0 +1,144 @@
+import datetime
+import os
+import re
+from typing import Callable, NamedTuple, Optional
+
+import metview as mv
+import numpy as np
+
+import util
+
+
+class Window(NamedTuple):
+    date: datetime.date
+    # "daytime" or "nighttime"
+    name: str
+    # validity times of the fields reduced over, naive UTC
+    validity: tuple[datetime.datetime, ...]
+
+
+def daytime(d: datetime.date, start_hour: int, end_hour: int) -> Window:
+    return Window(d, "daytime", tuple(
+        datetime.datetime.combine(d, datetime.time(hour=h)) for h in range(start_hour, end_hour + 1)))
+
+
+def nighttime(d: datetime.date, start_hour: int, end_hour: int) -> Window:
+    next_d = d + datetime.timedelta(days=1)
+    return Window(d, "nighttime", tuple(
+        [datetime.datetime.combine(d, datetime.time(hour=h)) for h in range(end_hour + 1, 24)] +
+        [datetime.datetime.combine(next_d, datetime.time(hour=h)) for h in range(0, start_hour)]))
+
+
+class Accumulator:
+    # Running min/max/sum of the fields of a window, so the fields don't need to be held at once
+
+    def __init__(self, window: Window):
+        self.window = window
+        self.seen: set[datetime.datetime] = set()
+        self._template: Optional[mv.Fieldset] = None
+        self._min: Optional[np.ndarray] = None
+        self._max: Optional[np.ndarray] = None
+        self._sum: Optional[np.ndarray] = None
+
+    def add(self, field: mv.Fieldset, validity: datetime.datetime):
+        values = field.values()
+        if self._template is None:
+            self._template = field
+            self._min = values.copy()
+            self._max = values.copy()
+            self._sum = values.astype(np.float64)
+        else:
+            # like metview's own reductions, a missing value in any field is missing in the result
+            np.minimum(self._min, values, out=self._min)
+            np.maximum(self._max, values, out=self._max)
+            self._sum += values
+        self.seen.add(validity)
+
+    def is_empty(self) -> bool:
+        return self._template is None
+
+    def is_complete(self) -> bool:
+        return self.seen.issuperset(self.window.validity)
+
+    def min(self) -> mv.Fieldset:
+        return self._template.set_values(self._min)
+
+    def max(self) -> mv.Fieldset:
+        return self._template.set_values(self._max)
+
+    def sum(self) -> mv.Fieldset:
+        return self._template.set_values(self._sum)
+
+
+class StreamingReducer:
+    # Folds each downloaded file into the accumulators of the windows it falls in as soon as it arrives. on_complete is
+    # called as soon as a window has all its fields, and by finish for windows that never got all of them.
+
+    def __init__(
+            self,
+            windows: list[Window],
+            on_complete: Callable[[Accumulator], None],
+            *,
+            validity_of: Optional[Callable[[mv.Fieldset], Optional[datetime.datetime]]] = None,
+    ):
+        self.accumulators = [Accumulator(w) for w in windows]
+        self.on_complete = on_complete
+        self.validity_of = validity_of or field_validity
+        self.data_ts: Optional[datetime.datetime] = None
+        self._done: set[int] = set()
+
+    def fold_file(self, path: str):
+        fs = mv.Fieldset(path=path)
+        print(f"Folding {os.path.basename(path)}")
+
+        data_ts = util.fieldset_data_datetime(fs)
+        if self.data_ts is None:
+            self.data_ts = data_ts
+        elif data_ts != self.data_ts:
+            raise RuntimeError(f"mixed model runs: {data_ts} and {self.data_ts}")
+
+        for field in fs:
+            validity = self.validity_of(field)
+            if validity is None:
+                continue
+            for (i, acc) in enumerate(self.accumulators):
+                if i not in self._done and validity in acc.window.validity:
+                    acc.add(field, validity)
+                    if acc.is_complete():
+                        self._done.add(i)
+                        self.on_complete(acc)
+
+    def finish(self):
+        for (i, acc) in enumerate(self.accumulators):
+            if i not in self._done and not acc.is_empty():
+                self._done.add(i)
+                self.on_complete(acc)
+
+
+def field_validity(field: mv.Fieldset) -> datetime.datetime:
+    row = field.ls(no_print=True, extra_keys=["validityDate", "validityTime"]).iloc[0]
+    return util.parse_numerical_timestamp(int(row["validityDate"]), int(row["validityTime"]))
+
+
+def file_id_validity(file_id: str) -> Optional[datetime.datetime]:
+    # Absolute Met Office file ids end in the validity time, e.g. agl_temperature_1.5_2024061512
+    m = re.search(r"_(\d{10})$", file_id)
+    if m is None:
+        return None
+    return datetime.datetime.strptime(m.group(1), "%Y%m%d%H")
+
+
+def plan_downloads(file_ids: list[str], windows: list[Window]) -> list[str]:
+    needed: set[datetime.datetime] = set()
+    for w in windows:
+        needed.update(w.validity)
+
+    planned = []
+    for file_id in file_ids:
+        validity = file_id_validity(file_id)
+        # a file we can't place is fetched rather than risk a window missing data
+        if validity is None or validity in needed:
+            planned.append(file_id)
+
+    print(f"Planned {len(planned)} of {len(file_ids)} files for {len(windows)} windows")
+    return planned
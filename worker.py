@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+# Long-running alternative to the CronJobs in infra/. Products run in a pool of worker processes that import metview
+# and GDAL once and are reused across jobs. Workers are replaced after a number of jobs to bound memory growth.
+#
+# Products are triggered on the internal schedule below, or with WORKER_WATCH=1 as soon as their next model run is
+# available (see run_watch), or by `POST /run/<product>`. `GET /status` lists recent jobs.
+#
+# This process must not import metview itself: the worker processes are forked from it and each needs its own
+# metview session.
+
+import http.server
+import importlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from typing import Callable, Optional
+
+import dateutil.parser
+import requests
+
+# product -> UTC times of day to run at, once for each model cycle, mirroring the schedules in infra/
+schedule = {
+    "icon_eu_h_snow": ["00:13", "06:13", "12:13", "18:13"],
+    "met_precip_accum": ["05:31", "11:31", "17:31", "23:31"],
+    "met_temp": ["05:31", "11:31", "17:31", "23:31"],
+    "met_wind_gust": ["05:31", "11:31", "17:31", "23:31"],
+}
+
+# product -> where its runs are published, mirroring the products' own download code
+watches = {
+    "icon_eu_h_snow": ("dwd", "h_snow"),
+    "met_precip_accum": ("metoffice", "plantopo-scotland-precip-accum"),
+    "met_temp": ("metoffice", "plantopo-scotland-temp-150cm"),
+    "met_wind_gust": ("metoffice", "plantopo-scotland-gust-10m"),
+}
+
+out_root = os.getenv("WORKER_OUT_DIR", "/out")
+processes = int(os.getenv("WORKER_PROCESSES", "2"))
+max_jobs_per_worker = int(os.getenv("WORKER_MAX_JOBS", "4"))
+port = int(os.getenv("WORKER_PORT", "8080"))
+
+# Polling backs off from the min to the max interval while nothing changes
+watch_min_interval = int(os.getenv("WATCH_MIN_INTERVAL", "60"))
+watch_max_interval = int(os.getenv("WATCH_MAX_INTERVAL", "900"))
+met_api_key = os.getenv("MET_ATMOSPHERIC_API_KEY")
+# mirroring util/dwd.py and icon_eu_h_snow.py, which this process can't import as util imports metview
+dwd_base_url = os.getenv("DWD_OPEN_DATA_URL", "https://opendata.dwd.de/weather/nwp").rstrip("/")
+dwd_run_hours = [0, 6, 12, 18]
+dwd_max_step = 120
+state_path = os.path.join(os.getenv("STATE_DIR"), "watch.json") if os.getenv("STATE_DIR") else None
+
+
+def _warm_up():
+    import metview as mv
+    import util
+
+    # metview starts its backend lazily, so force it up now rather than during the first job
+    mv.version_info()
+    for product in schedule.keys():
+        importlib.import_module(product)
+    print(f"Worker {os.getpid()} ready (gdal {util.gdal.__version__})", flush=True)
+
+
+def _run_product(product: str, out_dir: str):
+    importlib.import_module(product).main(out_dir)
+
+
+class Jobs:
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.running: set[str] = set()
+        self.history: list[dict] = []
+
+    def submit(self, product: str, on_done: Optional[Callable[[bool], None]] = None) -> bool:
+        # on_done is called with whether the job succeeded
+        with self.lock:
+            if product in self.running:
+                return False
+            self.running.add(product)
+
+        job = {"product": product, "started": datetime.now(timezone.utc).isoformat(), "status": "running"}
+        with self.lock:
+            self.history.append(job)
+            del self.history[:-50]
+
+        start = time.monotonic()
+
+        def on_success(_result):
+            self._finish(product, job, "succeeded", time.monotonic() - start)
+            if on_done is not None:
+                on_done(True)
+
+        def on_error(err):
+            traceback.print_exception(err)
+            self._finish(product, job, f"failed: {err!r}", time.monotonic() - start)
+            if on_done is not None:
+                on_done(False)
+
+        print(f"Starting {product}", flush=True)
+        self.pool.apply_async(
+            _run_product,
+            (product, os.path.join(out_root, product)),
+            callback=on_success,
+            error_callback=on_error,
+        )
+        return True
+
+    def _finish(self, product: str, job: dict, status: str, seconds: float):
+        print(f"Finished {product} in {seconds:.1f}s: {status}", flush=True)
+        with self.lock:
+            self.running.discard(product)
+            job["status"] = status
+            job["seconds"] = round(seconds, 1)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {"running": sorted(self.running), "history": list(self.history)}
+
+
+def run_schedule(jobs: Jobs):
+    last_triggered: dict[tuple[str, str], date] = {}
+    started_at = datetime.now(timezone.utc)
+    while True:
+        now = datetime.now(timezone.utc)
+        for (product, times) in schedule.items():
+            for t in times:
+                due = datetime.combine(now.date(), datetime.strptime(t, "%H:%M").time(), timezone.utc)
+                # don't fire for times that already passed before we started
+                if started_at <= due <= now and last_triggered.get((product, t)) != now.date():
+                    last_triggered[(product, t)] = now.date()
+                    if not jobs.submit(product):
+                        print(f"Skipping scheduled {product} as it is still running", flush=True)
+        time.sleep(15)
+
+
+class RunWatch:
+    # Finds the latest complete run of a product's source with conditional requests, so an unchanged listing costs
+    # a 304
+
+    def __init__(self, product: str, source: str, key: str):
+        self.product = product
+        self.source = source
+        self.key = key
+        self.interval = watch_min_interval
+        self.next_poll = 0.0
+        # url -> (validators, body) of the last 200
+        self._cache: dict[str, tuple[dict, bytes]] = {}
+
+    def _get(self, session: requests.Session, url: str, headers: Optional[dict] = None) -> tuple[bool, bytes]:
+        # (whether it changed since the last poll, body)
+        headers = dict(headers or {})
+        cached = self._cache.get(url)
+        if cached is not None:
+            headers.update(cached[0])
+
+        resp = session.get(url, headers=headers, timeout=30)
+        if resp.status_code == 304 and cached is not None:
+            return False, cached[1]
+        if resp.status_code == 404:
+            return cached is not None, b""
+        if resp.status_code != 200:
+            raise RuntimeError(f"got status {resp.status_code} polling {url}")
+
+        validators = {}
+        if "ETag" in resp.headers:
+            validators["If-None-Match"] = resp.headers["ETag"]
+        if "Last-Modified" in resp.headers:
+            validators["If-Modified-Since"] = resp.headers["Last-Modified"]
+        changed = cached is None or cached[1] != resp.content
+        self._cache[url] = (validators, resp.content)
+        return changed, resp.content
+
+    def latest_run(self, session: requests.Session) -> tuple[bool, Optional[datetime]]:
+        # (whether anything changed, the latest complete run)
+        if self.source == "metoffice":
+            (changed, body) = self._get(
+                session,
+                f"https://data.hub.api.metoffice.gov.uk/atmospheric-models/1.0.0/orders/{self.key}/latest?detail=minimal",
+                {"apikey": met_api_key},
+            )
+            runs = {f["runDateTime"] for f in json.loads(body)["orderDetails"]["files"]} if body else set()
+            # while the order is being updated it lists files from more than one run
+            if len(runs) != 1:
+                return changed, None
+            return changed, dateutil.parser.isoparse(runs.pop())
+
+        # Like util.dwd.latest_run: the latest main run, today or yesterday, with its last step published. Each run
+        # hour's directory holds that hour's latest run.
+        now = datetime.now(timezone.utc)
+        listings = {}
+        any_changed = False
+        for hour in dwd_run_hours:
+            (changed, body) = self._get(session, f"{dwd_base_url}/icon-eu/grib/{hour:02d}/{self.key.lower()}/")
+            listings[hour] = body.decode("utf8", errors="replace")
+            any_changed = any_changed or changed
+        for day in [now.date(), now.date() - timedelta(days=1)]:
+            for hour in reversed(dwd_run_hours):
+                run = datetime.combine(day, dt_time(hour=hour), timezone.utc)
+                last_file = f"_{run.strftime('%Y%m%d%H')}_{dwd_max_step:03d}_{self.key.upper()}.grib2.bz2"
+                if run <= now and last_file in listings[hour]:
+                    return any_changed, run
+        return any_changed, None
+
+
+def _load_triggered() -> dict[str, str]:
+    if state_path is None or not os.path.exists(state_path):
+        return {}
+    with open(state_path, "r") as f:
+        return json.load(f)
+
+
+def _save_triggered(triggered: dict[str, str]):
+    if state_path is None:
+        return
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(triggered, f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def run_watch(jobs: Jobs):
+    # Triggers each product once per new run, retrying it at the next poll if it fails. Polling speeds back up
+    # whenever a listing changes, as a run is then usually landing.
+    session = requests.Session()
+    watchers = [RunWatch(product, source, key) for (product, (source, key)) in watches.items()]
+    # product -> the last run that succeeded, persisted, and the run of the job in progress
+    triggered = _load_triggered()
+    submitted: dict[str, str] = {}
+    lock = threading.Lock()
+
+    def on_done(product: str, run: str) -> Callable[[bool], None]:
+        def done(succeeded: bool):
+            # called from the pool's result thread
+            with lock:
+                submitted.pop(product, None)
+                if succeeded:
+                    triggered[product] = run
+                    _save_triggered(triggered)
+                else:
+                    print(f"Run {run} of {product} failed, retrying at the next poll", flush=True)
+
+        return done
+
+    while True:
+        now = time.monotonic()
+        for w in watchers:
+            if now < w.next_poll:
+                continue
+            try:
+                (changed, run) = w.latest_run(session)
+            except Exception as e:
+                print(f"Failed to poll for {w.product}: {e!r}", flush=True)
+                changed = False
+                run = None
+
+            with lock:
+                is_new = run is not None and run.isoformat() not in (triggered.get(w.product),
+                                                                     submitted.get(w.product))
+            if is_new:
+                with lock:
+                    started = jobs.submit(w.product, on_done=on_done(w.product, run.isoformat()))
+                    if started:
+                        submitted[w.product] = run.isoformat()
+                if started:
+                    print(f"Run {run.isoformat()} of {w.product} is available", flush=True)
+                    # the next run is hours away
+                    w.interval = watch_max_interval
+                else:
+                    w.interval = watch_min_interval
+            elif changed:
+                w.interval = watch_min_interval
+            else:
+                w.interval = min(w.interval * 2, watch_max_interval)
+            w.next_poll = now + w.interval
+        time.sleep(5)
+
+
+def make_request_handler(jobs: Jobs):
+    # noinspection PyPep8Naming
+    class RequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/status":
+                self._respond(404, {"error": "not found"})
+                return
+            self._respond(200, jobs.status())
+
+        def do_POST(self):
+            if not self.path.startswith("/run/"):
+                self._respond(404, {"error": "not found"})
+                return
+
+            product = self.path[len("/run/"):]
+            if product not in schedule:
+                self._respond(404, {"error": f"unknown product {product}"})
+            elif jobs.submit(product):
+                self._respond(202, {"started": product})
+            else:
+                self._respond(409, {"error": f"{product} is already running"})
+
+        def _respond(self, status: int, body: dict):
+            self.send_response(status)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode('utf-8'))
+
+    return RequestHandler
+
+
+if __name__ == "__main__":
+    pool = multiprocessing.get_context("fork").Pool(
+        processes=processes,
+        initializer=_warm_up,
+        maxtasksperchild=max_jobs_per_worker,
+    )
+    jobs = Jobs(pool)
+
+    if os.getenv("WORKER_WATCH", "").strip().lower() in ("1", "true", "yes"):
+        threading.Thread(target=run_watch, args=(jobs,), daemon=True).start()
+    else:
+        threading.Thread(target=run_schedule, args=(jobs,), daemon=True).start()
+
+    addr = ('', port)
+    print(f"Listening on {addr[0]}:{addr[1]}")
+    httpd = http.server.ThreadingHTTPServer(addr, make_request_handler(jobs))
+    httpd.serve_forever()